@@ -0,0 +1,317 @@
+"""Benchmark harness for the conversion pipeline.
+
+Generates a deterministic local corpus, runs convert_directory, the pool path behind
+process_directories and cleanup_output_directory against it, and writes files/s, MB/s,
+stage times and peak RSS to a JSON results file. It also times a cold start of the CLI and
+of the GUI (where a display is available) up to their first processed file. Results can be compared against a stored
+baseline to flag regressions:
+
+    python benchmark.py --scale small --save-baseline
+    python benchmark.py --scale small --baseline benchmark_baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+
+from PIL import Image
+import pillow_heif
+
+import main
+
+# Number of files of each sort per corpus layout (flat and nested)
+CORPUS_SCALES = {
+    'small': {'images': 4, 'sdr_videos': 1, 'hdr_videos': 1, 'passthrough': 20},
+    'full': {'images': 40, 'sdr_videos': 4, 'hdr_videos': 2, 'passthrough': 400},
+}
+IMAGE_RESOLUTIONS = [(4032, 3024), (1920, 1440), (640, 480)]
+VIDEO_SIZE = '1280x720'
+VIDEO_SECONDS = 3
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Starts the GUI and converts one directory pair through it, as the Convert All button does
+GUI_STARTUP_SCRIPT = """
+import sys
+from gui import MediaConverterGUI
+app = MediaConverterGUI()
+app.window.update()
+app.process_directories([(sys.argv[1], sys.argv[2])], 1)
+"""
+
+# A stage is a regression when it gets this much slower than the baseline, and by more than
+# a few milliseconds so that near-instant stages do not flag on noise
+DEFAULT_TOLERANCE = 0.15
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def write_image(path, size, rng):
+    """A HEIC with real structure in it, deterministic for a given rng state"""
+    x, y = rng.uniform(-2.0, -0.5), rng.uniform(-1.2, 0.2)
+    extent = rng.uniform(0.2, 1.5)
+    img = Image.effect_mandelbrot(size, (x, y, x + extent, y + extent), 64)
+    tint = Image.new('L', size, rng.randrange(256))
+    Image.merge('RGB', (img, tint, img.point(lambda value: 255 - value))).save(path, quality=90)
+
+
+def write_video(path, hdr, seed):
+    source = f'testsrc2=size={VIDEO_SIZE}:rate=30:duration={VIDEO_SECONDS}'
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', source,
+               '-f', 'lavfi', '-i', f'sine=frequency={200 + seed * 50}:duration={VIDEO_SECONDS}']
+    if hdr:
+        command += ['-c:v', 'libx265', '-pix_fmt', 'yuv420p10le', '-x265-params', 'log-level=error',
+                    '-color_primaries', 'bt2020', '-color_trc', 'smpte2084', '-colorspace', 'bt2020nc']
+    else:
+        command += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+    subprocess.run(command + ['-c:a', 'aac', '-shortest', path], check=True)
+
+
+def generate_corpus(root, scale):
+    """Build the corpus under root in a flat and a nested layout, returning its input dirs"""
+    counts = CORPUS_SCALES[scale]
+    pillow_heif.register_heif_opener()
+    input_dirs = []
+
+    for layout in ('flat', 'nested'):
+        rng = random.Random(f"{scale}-{layout}")
+        input_dir = os.path.join(root, layout)
+        input_dirs.append(input_dir)
+
+        def place(name, index):
+            # The nested layout spreads files over two levels of subfolders
+            folder = input_dir if layout == 'flat' else os.path.join(input_dir, f"day_{index % 3}", f"burst_{index % 2}")
+            os.makedirs(folder, exist_ok=True)
+            return os.path.join(folder, name)
+
+        for i in range(counts['images']):
+            size = IMAGE_RESOLUTIONS[i % len(IMAGE_RESOLUTIONS)]
+            write_image(place(f"IMG_{i:04d}.HEIC", i), size, rng)
+            # Every image comes with its edit sidecar, as on an iPhone export
+            with open(place(f"IMG_{i:04d}.AAE", i), 'w') as f:
+                f.write("<plist/>")
+        for i in range(counts['sdr_videos']):
+            write_video(place(f"SDR_{i:04d}.MOV", i), False, i)
+        for i in range(counts['hdr_videos']):
+            write_video(place(f"HDR_{i:04d}.MOV", i), True, i)
+        for i in range(counts['passthrough']):
+            with open(place(f"FILE_{i:04d}.jpg", i), 'wb') as f:
+                f.write(rng.randbytes(rng.randrange(50_000, 2_000_000)))
+        # Identical passthrough files so cleanup has duplicates to find
+        shutil.copyfile(place("FILE_0000.jpg", 0), place("FILE_0000 copy.jpg", 1))
+
+    return input_dirs
+
+
+def generate_startup_input(input_dir):
+    """A single small photo for the cold start measurements"""
+    pillow_heif.register_heif_opener()
+    os.makedirs(input_dir)
+    write_image(os.path.join(input_dir, "IMG_START.HEIC"), IMAGE_RESOLUTIONS[-1], random.Random("startup"))
+
+
+def run_in_child(target, *args):
+    """Run target in a spawned process, so whatever it decodes does not inflate later stages'
+    peak RSS (ru_maxrss carries over from the process that starts them)"""
+    process = multiprocessing.get_context('spawn').Process(target=target, args=args)
+    process.start()
+    process.join()
+    return process.exitcode == 0
+
+
+def time_to_first_file(command, output_dir, first_file):
+    """Seconds from launching command until first_file(process) returns, on an empty output_dir"""
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.perf_counter()
+    with subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          text=True) as process:
+        if not first_file(process):
+            process.kill()
+            return None
+        elapsed = time.perf_counter() - start
+        process.communicate()
+    return elapsed if process.returncode == 0 else None
+
+
+def measure_startup(work_dir):
+    """Cold start to first processed file of the CLI, and of the GUI when it can open a window"""
+    input_dir = os.path.join(work_dir, "startup_input")
+    if not os.path.exists(input_dir) and not run_in_child(generate_startup_input, input_dir):
+        shutil.rmtree(input_dir, ignore_errors=True)
+        raise RuntimeError("Startup input generation failed")
+    output_dir = os.path.join(work_dir, "output_startup")
+
+    def first_cli_event(process):
+        return any(json.loads(line)['event'] == 'file' for line in process.stdout)
+
+    def gui_finished(process):
+        # The script exits right after the first (and only) file
+        return process.wait() == 0
+
+    cli_command = [sys.executable, os.path.join(REPO_DIR, 'main.py'), '--convert', input_dir, output_dir,
+                   '--no-cleanup']
+    gui_command = [sys.executable, '-c', GUI_STARTUP_SCRIPT, input_dir, output_dir]
+    return {
+        'startup_cli': time_to_first_file(cli_command, output_dir, first_cli_event),
+        'startup_gui': time_to_first_file(gui_command, output_dir, gui_finished),
+    }
+
+
+def corpus_size(input_dirs):
+    records = [record for input_dir in input_dirs for record in main.scan_directory(input_dir)]
+    return len(records), sum(record['size'] for record in records)
+
+
+def stage_scan(directory_data, settings):
+    for input_dir, _ in directory_data:
+        main.scan_directory(input_dir)
+
+
+def stage_convert_directory(directory_data, settings):
+    for dir_index, (input_dir, output_dir) in enumerate(directory_data):
+        main.convert_directory(input_dir, output_dir, {}, dir_index, settings)
+
+
+def stage_pool(directory_data, settings):
+    main.run_conversion(directory_data, settings)
+
+
+def stage_cleanup(directory_data, settings):
+    main.cleanup_all_directories(directory_data)
+
+
+def stage_worker(stage, directory_data, settings, results):
+    start = time.perf_counter()
+    stage(directory_data, settings)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KB on Linux; children covers the pool workers and ffmpeg
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    results.put({'seconds': elapsed, 'peak_rss_mb': own / 1024, 'peak_child_rss_mb': children / 1024})
+
+
+def run_stage(stage, directory_data, settings):
+    """Run one stage in a fresh process so its peak RSS is its own"""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=stage_worker, args=(stage, directory_data, settings, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def run_benchmark(work_dir, scale, settings=None):
+    corpus_dir = os.path.join(work_dir, f"corpus_{scale}")
+    if not os.path.exists(corpus_dir):
+        print(f"Generating {scale} corpus in {corpus_dir}...")
+        if not run_in_child(generate_corpus, corpus_dir, scale):
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+            raise RuntimeError("Corpus generation failed")
+    input_dirs = [os.path.join(corpus_dir, layout) for layout in ('flat', 'nested')]
+    num_files, num_bytes = corpus_size(input_dirs)
+
+    def fresh_outputs(name):
+        output_root = os.path.join(work_dir, f"output_{name}")
+        shutil.rmtree(output_root, ignore_errors=True)
+        pairs = []
+        for input_dir in input_dirs:
+            output_dir = os.path.join(output_root, os.path.basename(input_dir))
+            os.makedirs(output_dir)
+            pairs.append((input_dir, output_dir))
+        return pairs
+
+    stages = {}
+    pool_pairs = fresh_outputs('pool')
+    for name, stage, pairs in (
+            ('scan', stage_scan, pool_pairs),
+            ('convert_directory', stage_convert_directory, fresh_outputs('serial')),
+            ('pool', stage_pool, pool_pairs),
+            ('cleanup', stage_cleanup, pool_pairs)):
+        print(f"Running {name}...")
+        result = run_stage(stage, pairs, settings)
+        result['files_per_second'] = num_files / result['seconds']
+        result['mb_per_second'] = num_bytes / 1024 / 1024 / result['seconds']
+        stages[name] = result
+        print(f"- {name}: {result['seconds']:.2f}s, {result['files_per_second']:.1f} files/s, "
+              f"{result['mb_per_second']:.1f} MB/s, peak RSS {result['peak_rss_mb']:.0f} MB "
+              f"(children {result['peak_child_rss_mb']:.0f} MB)")
+
+    print("Timing cold starts...")
+    for name, seconds in measure_startup(work_dir).items():
+        if seconds is None:
+            print(f"- {name}: skipped (could not start, e.g. no display for the GUI)")
+            continue
+        stages[name] = {'seconds': seconds}
+        print(f"- {name}: {seconds:.2f}s to the first processed file")
+
+    return {
+        'scale': scale,
+        'timestamp': time.time(),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'settings': {**main.DEFAULT_SETTINGS, **(settings or {})},
+        'corpus': {'files': num_files, 'bytes': num_bytes},
+        'stages': stages,
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Stages that got slower than the baseline by more than tolerance, as messages"""
+    regressions = []
+    for name, stage in results['stages'].items():
+        reference = baseline.get('stages', {}).get(name)
+        if reference is None:
+            continue
+        change = stage['seconds'] / reference['seconds'] - 1
+        regressed = change > tolerance and stage['seconds'] - reference['seconds'] > MIN_REGRESSION_SECONDS
+        status = "REGRESSION" if regressed else "ok"
+        print(f"- {name}: {reference['seconds']:.2f}s -> {stage['seconds']:.2f}s ({change:+.1%}) {status}")
+        if regressed:
+            regressions.append(f"{name} is {change:.1%} slower than the baseline")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the media conversion pipeline")
+    parser.add_argument('--scale', choices=list(CORPUS_SCALES), default='small')
+    parser.add_argument('--work-dir', default='benchmark_data',
+                        help="where the corpus is generated (and reused) and outputs are written")
+    parser.add_argument('--results', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="baseline results file to compare against")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="also store these results as benchmark_baseline.json")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    results = run_benchmark(os.path.abspath(args.work_dir), args.scale)
+    with open(args.results, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"\nResults written to {args.results}")
+
+    if args.save_baseline:
+        with open('benchmark_baseline.json', 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Baseline saved to benchmark_baseline.json")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nComparing against {args.baseline}:")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,79 @@
+"""Compare the old Manager().dict progress channel with ProgressCounters.
+
+Generates a corpus of small passthrough files, copies it through ResourceExecutor and
+reports wall time for each way of tracking progress:
+
+    python benchmark_progress.py [number of files]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing import Manager
+
+from main import ProgressCounters, ResourceExecutor, build_file_tasks
+
+
+def make_corpus(root, num_files):
+    for i in range(num_files):
+        with open(os.path.join(root, f"file_{i:06d}.txt"), 'wb') as f:
+            f.write(os.urandom(256))
+
+
+def run_with_manager_dict(tasks, num_dirs):
+    """The previous path: a proxy write per file plus a thread summing the dict every 100ms"""
+    with Manager() as manager:
+        progress_dict = manager.dict()
+        for i in range(num_dirs):
+            progress_dict[i] = 0
+
+        done = threading.Event()
+
+        def update_progress():
+            while not done.is_set():
+                sum(progress_dict.values())
+                time.sleep(0.1)
+
+        poller = threading.Thread(target=update_progress, daemon=True)
+        poller.start()
+        with ResourceExecutor() as executor:
+            for task, _, _ in executor.run(tasks):
+                progress_dict[task['dir_index']] += 1
+        done.set()
+        poller.join()
+        return sum(progress_dict.values())
+
+
+def run_with_counters(tasks, num_dirs):
+    progress = ProgressCounters(num_dirs, len(tasks))
+    with ResourceExecutor() as executor:
+        for task, _, _ in executor.run(tasks):
+            progress.add(task['dir_index'])
+    return progress.snapshot()[0]
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    workdir = tempfile.mkdtemp(prefix="progress_bench_")
+    try:
+        input_dir = os.path.join(workdir, "input")
+        os.makedirs(input_dir)
+        make_corpus(input_dir, num_files)
+
+        for name, runner in (("Manager().dict", run_with_manager_dict), ("ProgressCounters", run_with_counters)):
+            output_dir = os.path.join(workdir, name)
+            os.makedirs(output_dir)
+            tasks = build_file_tasks([(input_dir, output_dir)])
+
+            start = time.perf_counter()
+            processed = runner(tasks, 1)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<18} {processed} files in {elapsed:.2f}s ({processed / elapsed:.0f} files/s)")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Check that a distributed run survives losing workers, all on localhost.
+
+Starts a coordinator on a free port and real worker processes next to it, plus stand-in
+workers that fail at the awkward moments, and checks every file still converts exactly
+once without the run hanging:
+
+    python check_distributed.py
+"""
+import os
+import sys
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import subprocess
+from multiprocessing.connection import Client
+
+import pillow_heif
+
+import distributed
+import main
+from benchmark import REPO_DIR, write_image
+
+AUTHKEY = b'check-distributed'
+NUM_IMAGES = 6
+RUN_TIMEOUT = 120
+# WORKER_TIMEOUT for the check with a worker that stops reading, still above the heartbeat
+STALL_TIMEOUT = 2 * distributed.HEARTBEAT_SECONDS
+STALLED_SOURCE_BYTES = 64 * 1024 * 1024
+
+
+def make_sources(input_dir, num_images):
+    pillow_heif.register_heif_opener()
+    os.makedirs(input_dir)
+    rng = random.Random("check_distributed")
+    for i in range(num_images):
+        write_image(os.path.join(input_dir, f"IMG_{i:04d}.HEIC"), (640, 480), rng)
+
+
+def start_worker(address, stream=False, authkey=AUTHKEY):
+    command = [sys.executable, os.path.join(REPO_DIR, 'main.py'), '--worker', f"{address[0]}:{address[1]}",
+               '--authkey', authkey.decode()]
+    return subprocess.Popen(command + (['--stream'] if stream else []), cwd=REPO_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def join_as_fake_worker(address, slots):
+    """Connect the way a streaming worker does, returning the connection once it has settings"""
+    conn = Client(address, authkey=AUTHKEY)
+    conn.send(('hello', {'host': 'fake', 'pid': os.getpid(), 'slots': slots, 'stream': True}))
+    conn.recv()
+    return conn
+
+
+def convert_with(coordinator, pairs, on_result):
+    """run_conversion on the coordinator in a thread, or None if it did not finish in time"""
+    finished = []
+
+    def target():
+        finished.append(main.run_conversion(pairs, executor=coordinator, on_result=on_result))
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(RUN_TIMEOUT)
+    return finished[0] if finished else None
+
+
+def check_results(results, converted, input_dir, output_dir):
+    """Problems with a finished run: failed files, files converted twice or missing outputs"""
+    if results is None:
+        return [f"the run did not finish within {RUN_TIMEOUT}s"]
+    problems = [message for pair_results in results for status, message in pair_results if status != "success"]
+    files = [task['file'] for task, _ in converted]
+    expected = sorted(main.scan_directory(input_dir), key=lambda record: record['file'])
+    if sorted(files) != [record['file'] for record in expected]:
+        problems.append(f"converted {sorted(files)} instead of each source once")
+    for task, _ in converted:
+        for path in main.output_paths_for(task['kind'], task['file'], task['output_dir']):
+            if not os.path.exists(path):
+                problems.append(f"{path} is missing")
+    for _, _, names in os.walk(output_dir):
+        problems += [f"{name} was left behind" for name in names if name.endswith('.partial')]
+    return problems
+
+
+def check_killed_worker(work_dir, input_dir, stream):
+    """Three workers, one killed once the first file is in, and one with the wrong key"""
+    output_dir = os.path.join(work_dir, f"killed_{'stream' if stream else 'path'}")
+    converted = []
+    with distributed.Coordinator(('127.0.0.1', 0), AUTHKEY) as coordinator:
+        workers = [start_worker(coordinator.address, stream) for _ in range(3)]
+        workers.append(start_worker(coordinator.address, stream, b'wrong-key'))
+
+        def on_result(task, status, message):
+            if not converted:
+                workers[0].send_signal(signal.SIGKILL)
+            converted.append((task, status))
+
+        try:
+            results = convert_with(coordinator, [(input_dir, output_dir)], on_result)
+        finally:
+            for worker in workers:
+                worker.kill()
+    return check_results(results, converted, input_dir, output_dir)
+
+
+def check_drop_mid_output(work_dir, input_dir):
+    """A streaming worker that goes away halfway through sending back its first output"""
+    output_dir = os.path.join(work_dir, "drop_mid_output")
+    converted = []
+    with distributed.Coordinator(('127.0.0.1', 0), AUTHKEY) as coordinator:
+        conn = join_as_fake_worker(coordinator.address, {'decode': 1, 'ffmpeg': 0, 'io': 0})
+
+        def drop_after_first_chunk():
+            with conn:
+                _, task = conn.recv()
+                distributed.receive_file(conn, os.path.join(work_dir, "drop_mid_output.source"))
+                output = os.path.relpath(main.output_paths_for(task['kind'], task['file'], '.')[0], '.')
+                conn.send(('result', task, "success", "", [output]))
+                conn.send_bytes(b'\0' * 1024)
+            # The real worker only joins once the fake one is gone
+            workers.append(start_worker(coordinator.address, stream=True))
+
+        workers = []
+        fake = threading.Thread(target=drop_after_first_chunk, daemon=True)
+        fake.start()
+        try:
+            results = convert_with(coordinator, [(input_dir, output_dir)], lambda task, status, message:
+                                   converted.append((task, status)))
+        finally:
+            fake.join(RUN_TIMEOUT)
+            for worker in workers:
+                worker.kill()
+    return check_results(results, converted, input_dir, output_dir)
+
+
+def check_stalled_reader(work_dir, input_dir):
+    """A streaming worker that takes a big source's task and then stops reading"""
+    stalled_input = os.path.join(work_dir, "stalled_input")
+    shutil.copytree(input_dir, stalled_input)
+    with open(os.path.join(stalled_input, "big.bin"), 'wb') as f:
+        for _ in range(STALLED_SOURCE_BYTES // distributed.CHUNK_BYTES):
+            f.write(os.urandom(distributed.CHUNK_BYTES))
+    output_dir = os.path.join(work_dir, "stalled_reader")
+    converted = []
+    worker_timeout, distributed.WORKER_TIMEOUT = distributed.WORKER_TIMEOUT, STALL_TIMEOUT
+    try:
+        with distributed.Coordinator(('127.0.0.1', 0), AUTHKEY) as coordinator:
+            # Only I/O slots, so the big file is what it gets
+            conn = join_as_fake_worker(coordinator.address, {'decode': 0, 'ffmpeg': 0, 'io': 1})
+            done = threading.Event()
+
+            def stop_reading():
+                with conn:
+                    # Give the coordinator time to start sending, then let the others in
+                    time.sleep(1)
+                    workers.append(start_worker(coordinator.address, stream=True))
+                    done.wait()
+
+            workers = []
+            fake = threading.Thread(target=stop_reading, daemon=True)
+            fake.start()
+            try:
+                results = convert_with(coordinator, [(stalled_input, output_dir)], lambda task, status, message:
+                                       converted.append((task, status)))
+            finally:
+                done.set()
+                fake.join(RUN_TIMEOUT)
+                for worker in workers:
+                    worker.kill()
+    finally:
+        distributed.WORKER_TIMEOUT = worker_timeout
+    return check_results(results, converted, stalled_input, output_dir)
+
+
+def main_cli():
+    work_dir = tempfile.mkdtemp(prefix="check_distributed_")
+    failed = False
+    try:
+        input_dir = os.path.join(work_dir, "input")
+        make_sources(input_dir, NUM_IMAGES)
+        checks = (
+            ("killed worker, shared paths", lambda: check_killed_worker(work_dir, input_dir, False)),
+            ("killed worker, streaming", lambda: check_killed_worker(work_dir, input_dir, True)),
+            ("worker lost mid-output", lambda: check_drop_mid_output(work_dir, input_dir)),
+            ("worker that stops reading", lambda: check_stalled_reader(work_dir, input_dir)),
+        )
+        for name, check in checks:
+            problems = check()
+            print(f"{'FAIL' if problems else 'PASS'} {name}")
+            for problem in problems:
+                print(f"  - {problem}")
+            failed = failed or bool(problems)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main_cli()
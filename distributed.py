@@ -0,0 +1,389 @@
+"""Coordinator/worker mode: one coordinator scans the directory pairs and owns the task
+queue, and workers on any number of hosts connect to it over TCP to convert files.
+
+Workers either read and write the coordinator's paths directly over a shared filesystem,
+or, started with stream=True, get each source streamed to them in chunks and stream the
+outputs back, spooled to disk on both ends.
+Connections are authenticated with a shared key (multiprocessing.connection's HMAC
+handshake). A worker that disconnects or goes silent has its files handed to the others.
+
+    python main.py --coordinator 0.0.0.0:6000 --authkey SECRET --convert IN OUT
+    python main.py --worker coordinator-host:6000 --authkey SECRET [--stream]
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+from contextlib import ExitStack
+from queue import Queue, Empty
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from main import (DEFAULT_SETTINGS, RESOURCE_CLASSES, ResourceExecutor, hold_duplicates, output_paths_for,
+                  release_duplicates)
+
+# A worker that has not been heard from, or has not taken a send, for this long is considered dead
+WORKER_TIMEOUT = 30.0
+HEARTBEAT_SECONDS = 5.0
+# How often connection handlers wake up to hand out work and check on their worker
+POLL_SECONDS = 0.2
+# Streamed files go over the connection in pieces of this size, so neither end ever holds a
+# whole source or output in memory
+CHUNK_BYTES = 1024 * 1024
+# A file is given up on after killing (or losing) this many workers
+MAX_ATTEMPTS = 3
+# Pool sizes and local paths come from the worker's own settings, everything else from the
+# coordinator's, so every host converts with the same parameters
+WORKER_LOCAL_SETTINGS = ('decode_workers', 'ffmpeg_slots', 'ffmpeg_threads', 'io_threads', 'memory_budget',
+                         'cache_dir', 'cache_max_bytes', 'trace_dir')
+
+
+def parse_address(text):
+    """(host, port) from HOST:PORT"""
+    host, _, port = text.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def set_stall_timeout(conn, seconds):
+    """Make sends and receives on conn raise an OSError once the other end has not taken or
+    sent anything for seconds, instead of blocking for good on a peer that hung"""
+    if sys.platform == 'win32':
+        value = struct.pack('L', int(seconds * 1000))
+    else:
+        value = struct.pack('ll', int(seconds), int(seconds % 1 * 1_000_000))
+    # A duplicate of the connection's socket, which shares its options
+    with socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+
+
+def send_file(conn, f):
+    """Send an open file as a run of chunks, ended by an empty one"""
+    for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+        conn.send_bytes(chunk)
+    conn.send_bytes(b'')
+
+
+def receive_file(conn, path):
+    """Write the chunks of a send_file to path, through a temporary file.
+
+    Every chunk is read even when writing fails, so the connection stays in step. Returns
+    the OSError writing failed with, or None; errors of the connection itself are raised.
+    """
+    partial_path = f"{path}.{os.getpid()}.partial"
+    error = None
+    try:
+        with ExitStack() as stack:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = stack.enter_context(open(partial_path, 'wb'))
+            except OSError as e:
+                error = e
+            while True:
+                chunk = conn.recv_bytes()
+                if not chunk:
+                    break
+                if error is None:
+                    try:
+                        f.write(chunk)
+                    except OSError as e:
+                        error = e
+    except (EOFError, OSError):
+        # The connection failed partway, so nothing half-written is left behind
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    try:
+        if error is None:
+            os.replace(partial_path, path)
+        elif os.path.exists(partial_path):
+            os.remove(partial_path)
+    except OSError as e:
+        error = e
+    return error
+
+
+class Coordinator:
+    """Hands file tasks out to connected workers, with the same run(tasks) interface as
+    ResourceExecutor so run_conversion can drive it in place of the local pools.
+
+    Tasks wait in a queue per resource class, and each worker gets as many of each class at
+    a time as its pool for that class has slots, so the big videos spread over the hosts'
+    ffmpeg slots instead of piling up on whichever worker connected first. Like the local
+    executor, sources sharing an output cache key are handed out one after the other.
+
+    Tasks of a worker whose connection drops, that misses heartbeats for WORKER_TIMEOUT or
+    that stops taking a send for as long, go back to the front of the queue for the others.
+    A task stays the worker's until all the outputs it streams back have arrived.
+    """
+
+    def __init__(self, address, authkey, settings=None, progress=None):
+        self.address = address
+        self.authkey = authkey
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.progress = progress
+        self.pending = {resource_class: deque() for resource_class in set(RESOURCE_CLASSES.values())}
+        self.waiting = {}  # cache key -> tasks held back until the one converting it finishes
+        self.lock = threading.Lock()
+        self.completed = Queue()
+        self.closing = threading.Event()
+        self.listener = None
+        self.threads = []
+
+    def __enter__(self):
+        self.listener = Listener(self.address, authkey=self.authkey)
+        # The bound address, which has the actual port when port 0 was asked for
+        self.address = self.listener.address
+        print(f"Coordinator listening on {self.address[0]}:{self.address[1]}")
+        accept_thread = threading.Thread(target=self.accept_workers, daemon=True)
+        accept_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closing.set()
+        self.listener.close()
+        for thread in self.threads:
+            thread.join()
+
+    def accept_workers(self):
+        while not self.closing.is_set():
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                if self.closing.is_set():
+                    return
+                continue  # Failed handshake, e.g. a wrong authkey or a client that hung up
+            thread = threading.Thread(target=self.serve_worker, args=(conn,), daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def next_task(self, resource_class):
+        with self.lock:
+            pending = self.pending[resource_class]
+            return pending.popleft() if pending else None
+
+    def queue(self, tasks):
+        with self.lock:
+            for task in tasks:
+                self.pending[RESOURCE_CLASSES[task['kind']]].append(task)
+
+    def requeue(self, tasks):
+        """Put the tasks of a lost worker back at the front of the queue"""
+        for task in tasks:
+            task['attempts'] = task.get('attempts', 0) + 1
+            if self.progress is not None:
+                self.progress.set_fraction(task, 0.0)
+            if task['attempts'] >= MAX_ATTEMPTS:
+                self.completed.put((task, "error", f"Error processing {task['file']}: "
+                                                   f"{task['attempts']} workers were lost while on it"))
+                continue
+            with self.lock:
+                self.pending[RESOURCE_CLASSES[task['kind']]].appendleft(task)
+
+    def send_task(self, conn, task, source):
+        """Send a task, followed by its source's content when source is the open file"""
+        conn.send(('task', task))
+        if source is not None:
+            with source:
+                send_file(conn, source)
+
+    def finish_task(self, conn, task, returned, status, message, outputs):
+        """Merge a worker's result into the coordinator's own task, receive the outputs a
+        streaming worker sends after it, and queue it as completed"""
+        # Keep the coordinator's paths; a streaming worker ran on copies in its scratch space
+        task = {**returned, 'input_path': task['input_path'], 'output_dir': task['output_dir']}
+        errors = [receive_file(conn, os.path.join(task['output_dir'], rel_path)) for rel_path in outputs]
+        error = next((error for error in errors if error is not None), None)
+        if error is not None:
+            status, message = "error", f"Error writing outputs of {task['file']}: {str(error)}"
+        self.completed.put((task, status, message))
+
+    def serve_worker(self, conn):
+        in_flight = {}  # task_id -> task
+        name = "worker"
+        try:
+            # A worker that stopped reading would otherwise block a source being sent to it forever
+            set_stall_timeout(conn, WORKER_TIMEOUT)
+            kind, hello = conn.recv()
+            name = f"{hello['host']}:{hello['pid']}"
+            slots = hello['slots']
+            busy = dict.fromkeys(slots, 0)  # resource class -> tasks in flight
+            conn.send(('settings', self.settings))
+            print(f"Worker {name} joined with {slots['decode']} decode, {slots['ffmpeg']} ffmpeg and "
+                  f"{slots['io']} I/O slots" + (" (streaming)" if hello['stream'] else ""))
+            last_seen = time.monotonic()
+
+            while not self.closing.is_set():
+                for resource_class, credits in slots.items():
+                    while busy[resource_class] < credits:
+                        task = self.next_task(resource_class)
+                        if task is None:
+                            break
+                        try:
+                            # Opened before anything is sent, so a source gone missing only fails itself
+                            source = open(task['input_path'], 'rb') if hello['stream'] else None
+                        except OSError as e:
+                            self.completed.put((task, "error", f"Error reading {task['file']}: {str(e)}"))
+                            continue
+                        in_flight[task['task_id']] = task
+                        busy[resource_class] += 1
+                        self.send_task(conn, task, source)
+
+                if not conn.poll(POLL_SECONDS):
+                    if time.monotonic() - last_seen > WORKER_TIMEOUT:
+                        raise TimeoutError(f"no heartbeat for {WORKER_TIMEOUT:.0f}s")
+                    continue
+                message = conn.recv()
+                last_seen = time.monotonic()
+                if message[0] == 'progress':
+                    _, task_id, fraction = message
+                    if self.progress is not None and task_id in in_flight:
+                        self.progress.set_fraction(in_flight[task_id], fraction)
+                elif message[0] == 'result':
+                    _, returned, status, text, outputs = message
+                    # Only done once its outputs are in, so losing the worker meanwhile requeues it
+                    task = in_flight[returned['task_id']]
+                    self.finish_task(conn, task, returned, status, text, outputs)
+                    del in_flight[returned['task_id']]
+                    busy[RESOURCE_CLASSES[task['kind']]] -= 1
+
+            conn.send(('stop',))
+        except (EOFError, OSError, TimeoutError) as e:
+            # A send or receive that ran into the stall timeout fails as if non-blocking
+            reason = (f"stalled for {WORKER_TIMEOUT:.0f}s" if isinstance(e, BlockingIOError)
+                      else str(e) or 'connection closed')
+            print(f"Lost worker {name} ({reason}), handing its {len(in_flight)} files to the others")
+            self.requeue(in_flight.values())
+        finally:
+            conn.close()
+
+    def run(self, tasks):
+        """Queue tasks for the workers and yield (task, status, message) as each completes"""
+        self.queue(hold_duplicates(tasks, self.waiting))
+        for _ in range(len(tasks)):
+            task, status, message = self.completed.get()
+            self.queue(release_duplicates(task, status, self.waiting))
+            yield task, status, message
+
+
+class WorkerProgress:
+    """Stands in for ProgressCounters in a worker's ResourceExecutor, passing the fraction
+    done of running files on to the coordinator"""
+
+    def __init__(self, send):
+        self.send = send
+
+    def set_fraction(self, task, fraction):
+        self.send(('progress', task['task_id'], fraction))
+
+
+def run_worker(address, authkey, stream=False, settings=None):
+    """Connect to a coordinator and convert the files it hands out until it is done.
+    Returns False if the coordinator could not be joined.
+
+    Tasks go through the executor's memory budget like local ones. With stream, sources are
+    received into a scratch directory and the outputs sent back from there, for hosts that
+    do not share the coordinator's filesystem.
+    """
+    local_settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    # Credits per resource class: how many tasks of each the coordinator may hand out at once
+    slots = {'decode': local_settings['decode_workers'], 'ffmpeg': local_settings['ffmpeg_slots'],
+             'io': local_settings['io_threads']}
+    try:
+        conn = Client(address, authkey=authkey)
+        conn.send(('hello', {'host': socket.gethostname(), 'pid': os.getpid(), 'slots': slots, 'stream': stream}))
+        _, coordinator_settings = conn.recv()
+    except AuthenticationError:
+        print(f"Coordinator at {address[0]}:{address[1]} rejected the authkey")
+        return False
+    except (OSError, EOFError) as e:
+        # Also what a worker started after the coordinator finished gets
+        print(f"Could not join coordinator at {address[0]}:{address[1]}: {str(e) or 'connection closed'}")
+        return False
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    worker_settings = {**coordinator_settings, **{key: local_settings[key] for key in WORKER_LOCAL_SETTINGS}}
+
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                send(('heartbeat',))
+            except OSError:
+                return
+
+    with ResourceExecutor(worker_settings, WorkerProgress(send)) as executor, \
+            tempfile.TemporaryDirectory(prefix='media-worker-') as scratch_dir:
+
+        def forward_results():
+            while True:
+                try:
+                    task, status, message = executor.finished(timeout=POLL_SECONDS)
+                except Empty:
+                    if stopped.is_set():
+                        return
+                    continue
+                # Memory it held may let waiting tasks in
+                executor.admit()
+                try:
+                    with ExitStack() as stack:
+                        outputs = {}
+                        if stream:
+                            for path in output_paths_for(task['kind'], task['file'], task['output_dir'],
+                                                         worker_settings):
+                                if os.path.exists(path):
+                                    outputs[os.path.relpath(path, task['output_dir'])] = \
+                                        stack.enter_context(open(path, 'rb'))
+                        # The outputs follow their result without other messages in between
+                        with send_lock:
+                            conn.send(('result', task, status, message, list(outputs)))
+                            for f in outputs.values():
+                                send_file(conn, f)
+                except OSError:
+                    return
+                if stream:
+                    shutil.rmtree(os.path.join(scratch_dir, str(task['task_id'])), ignore_errors=True)
+
+        threads = [threading.Thread(target=heartbeat, daemon=True),
+                   threading.Thread(target=forward_results, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'stop':
+                    break
+                _, task = message
+                if stream:
+                    # Run on a private copy of the source, into a private output directory
+                    task_dir = os.path.join(scratch_dir, str(task['task_id']))
+                    input_path = os.path.join(task_dir, 'input', task['file'])
+                    error = receive_file(conn, input_path)
+                    task = {**task, 'input_path': input_path, 'output_dir': os.path.join(task_dir, 'output')}
+                    if error is not None:
+                        # Reported through the results thread, as this one must never wait to send.
+                        # It was never admitted, so it has no memory to give back.
+                        executor.completed.put(({**task, 'footprint': 0}, "error",
+                                                f"Error receiving {task['file']}: {str(error)}"))
+                        continue
+                executor.enqueue([task])
+                executor.admit()
+        except EOFError:
+            print("Coordinator went away")
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
+            conn.close()
+    return True
@@ -0,0 +1,452 @@
+import os
+import threading
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+from queue import Queue, Empty
+from collections import deque
+import multiprocessing
+
+from main import (IMAGE_EXTENSIONS, ProgressCounters, cleanup_all_directories, format_duration,
+                  generated_dirs, get_file_counts, load_directory_pairs, load_settings, mirror_directory_pairs,
+                  run_conversion, save_settings, scan_directory)
+
+# Lines kept in the status box; the log file gets all of them
+STATUS_LOG_LINES = 1000
+LOG_PATH = os.path.expanduser('~/.mass-media-converter.log')
+
+
+class MediaConverterGUI:
+    def __init__(self):
+        self.window = tk.Tk()
+        self.window.title("Multi-Folder Media Converter")
+        self.window.geometry("800x600")
+
+        # Input/output directory pairs by their row in pair_tree
+        self.directory_pairs = {}
+
+        # Create main container
+        self.main_container = ttk.Frame(self.window)
+        self.main_container.pack(fill='both', expand=True, padx=10, pady=10)
+
+        # Directory list frame
+        self.dir_list_frame = ttk.LabelFrame(self.main_container, text="Directory Pairs")
+        self.dir_list_frame.pack(fill='both', expand=True, padx=5, pady=5)
+
+        # Total progress frame
+        self.total_progress_frame = ttk.Frame(self.main_container)
+        self.total_progress_frame.pack(fill='x', padx=5, pady=5)
+
+        self.total_progress_label = ttk.Label(self.total_progress_frame, text="Total Progress: ")
+        self.total_progress_label.pack(side='left')
+
+        self.total_progress = ttk.Progressbar(self.total_progress_frame, mode='determinate')
+        self.total_progress.pack(side='left', fill='x', expand=True, padx=5)
+
+        self.progress_text = ttk.Label(self.total_progress_frame, text="0/0 files")
+        self.progress_text.pack(side='left')
+
+        # One row per directory pair instead of a set of widgets per pair: the Treeview only
+        # draws the rows in view, so thousands of pairs stay responsive
+        self.pair_tree = ttk.Treeview(self.dir_list_frame, columns=('input', 'output', 'status', 'progress'),
+                                      show='headings', selectmode='extended')
+        for column, heading, width, stretch in (('input', "Input", 250, True), ('output', "Output", 250, True),
+                                                ('status', "Status", 90, False),
+                                                ('progress', "Progress", 90, False)):
+            self.pair_tree.heading(column, text=heading)
+            self.pair_tree.column(column, width=width, stretch=stretch)
+        self.scrollbar = ttk.Scrollbar(self.dir_list_frame, orient="vertical", command=self.pair_tree.yview)
+        self.pair_tree.configure(yscrollcommand=self.scrollbar.set)
+
+        self.pair_tree.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        # Image output options, starting from the saved config
+        self.settings = load_settings()
+
+        self.image_options_frame = ttk.LabelFrame(self.main_container, text="Image Output")
+        self.image_options_frame.pack(fill='x', padx=5, pady=5)
+
+        self.image_format_var = tk.StringVar(value=self.settings['image_format'])
+        self.image_quality_var = tk.IntVar(value=self.settings['image_quality'])
+        self.png_compress_var = tk.IntVar(value=self.settings['png_compress_level'])
+        self.webp_lossless_var = tk.BooleanVar(value=self.settings['webp_lossless'])
+
+        ttk.Label(self.image_options_frame, text="Format:").pack(side='left', padx=5)
+        ttk.Combobox(self.image_options_frame, textvariable=self.image_format_var, state='readonly',
+                     values=list(IMAGE_EXTENSIONS), width=6).pack(side='left')
+        ttk.Label(self.image_options_frame, text="Quality:").pack(side='left', padx=5)
+        ttk.Spinbox(self.image_options_frame, textvariable=self.image_quality_var, from_=1, to=100,
+                    width=4).pack(side='left')
+        ttk.Label(self.image_options_frame, text="PNG compression:").pack(side='left', padx=5)
+        ttk.Spinbox(self.image_options_frame, textvariable=self.png_compress_var, from_=0, to=9,
+                    width=3).pack(side='left')
+        ttk.Checkbutton(self.image_options_frame, text="Lossless WebP",
+                        variable=self.webp_lossless_var).pack(side='left', padx=5)
+
+        # Buttons frame
+        self.button_frame = ttk.Frame(self.main_container)
+        self.button_frame.pack(fill='x', pady=10)
+
+        self.add_pair_button = ttk.Button(self.button_frame, text="Add Directory Pair", command=self.add_directory_pair)
+        self.add_pair_button.pack(side='left', padx=5)
+
+        self.import_pairs_button = ttk.Button(self.button_frame, text="Import Pairs...", command=self.import_pairs)
+        self.import_pairs_button.pack(side='left', padx=5)
+
+        self.mirror_tree_button = ttk.Button(self.button_frame, text="Mirror Tree...", command=self.mirror_tree)
+        self.mirror_tree_button.pack(side='left', padx=5)
+
+        self.remove_pair_button = ttk.Button(self.button_frame, text="Remove Selected",
+                                             command=self.remove_selected_pair)
+        self.remove_pair_button.pack(side='left', padx=5)
+
+        self.convert_button = ttk.Button(self.button_frame, text="Convert All", command=self.start_conversion)
+        self.convert_button.pack(side='right', padx=5)
+
+        # Status text
+        self.status_frame = ttk.LabelFrame(self.main_container, text="Status")
+        self.status_frame.pack(fill='both', expand=True, padx=5, pady=5)
+
+        self.errors_only_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.status_frame, text="Errors only", variable=self.errors_only_var,
+                        command=self.refresh_status_log).pack(anchor='w')
+
+        self.status_text = tk.Text(self.status_frame, height=10, width=50)
+        self.status_text.pack(fill='both', expand=True)
+
+        # (status, message) updates from the conversion thread, drained by check_queues into
+        # a capped log; the full log goes to LOG_PATH
+        self.status_queue = Queue()
+        self.status_log = deque(maxlen=STATUS_LOG_LINES)
+        self.log_file = None
+
+        # Progress counters of the running conversion, polled by check_queues
+        self.progress = None
+        self.last_progress = None
+        self.window.after(100, self.check_queues)
+
+        # Buttons that change the pair list, disabled while a conversion runs
+        self.pair_buttons = [self.add_pair_button, self.import_pairs_button, self.mirror_tree_button,
+                             self.remove_pair_button]
+
+        # Rows of the running conversion in directory order, with their file and error counts
+        self.active_rows = []
+        self.row_totals = []
+        self.row_errors = []
+        self.row_shown = []
+
+    def insert_pairs(self, pairs):
+        for input_dir, output_dir in pairs:
+            row = self.pair_tree.insert('', tk.END, values=(input_dir, output_dir, "Pending", ""))
+            self.directory_pairs[row] = {'input': input_dir, 'output': output_dir}
+
+    def remove_selected_pair(self):
+        selected = self.pair_tree.selection()
+        self.pair_tree.delete(*selected)
+        for row in selected:
+            del self.directory_pairs[row]
+
+    def add_directory_pair(self):
+        input_dir = filedialog.askdirectory(title="Input directory")
+        if not input_dir:
+            return
+        output_dir = filedialog.askdirectory(title="Output directory")
+        if output_dir:
+            self.insert_pairs([(input_dir, output_dir)])
+
+    def import_pairs(self):
+        path = filedialog.askopenfilename(title="Import directory pairs",
+                                          filetypes=[("Pair lists", "*.csv *.json"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            pairs = load_directory_pairs(path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            messagebox.showerror("Error", f"Could not import {path}: {str(e)}")
+            return
+        self.insert_pairs(pairs)
+        self.update_status(f"Imported {len(pairs)} directory pairs from {path}")
+
+    def mirror_tree(self):
+        input_root = filedialog.askdirectory(title="Tree to mirror (one pair per subfolder)")
+        if not input_root:
+            return
+        output_root = filedialog.askdirectory(title="Mirror into")
+        if not output_root:
+            return
+        pairs = mirror_directory_pairs(input_root, output_root)
+        if not pairs:
+            messagebox.showerror("Error", f"No subfolders found in {input_root}")
+            return
+        self.insert_pairs(pairs)
+        self.update_status(f"Added {len(pairs)} directory pairs mirroring {input_root} into {output_root}")
+
+    def update_status(self, message, status='info'):
+        self.status_queue.put((status, message))
+
+    def process_directories(self, directory_data, total_files, settings=None, scans=None):
+        self.last_progress = None
+        self.progress = ProgressCounters(len(directory_data), total_files)
+
+        def on_result(task, status, message):
+            # Straight to the status box as each file finishes
+            self.update_status(message, status)
+            if status == 'error':
+                self.row_errors[task['dir_index']] += 1
+            print(message)
+
+        return run_conversion(directory_data, settings, scans, self.progress, on_result=on_result)
+
+    def shown_in_log(self, status):
+        return status == 'error' or not self.errors_only_var.get()
+
+    def refresh_status_log(self):
+        """Redraw the status box from the kept lines, e.g. after the filter changed"""
+        self.status_text.delete('1.0', tk.END)
+        self.status_text.insert(tk.END, ''.join(message + "\n" for status, message in self.status_log
+                                                if self.shown_in_log(status)))
+        self.status_text.see(tk.END)
+
+    def drain_status_queue(self):
+        """Move every queued update into the log file, the kept lines and the status box,
+        with one insert into the Text widget however many arrived since the last tick"""
+        updates = []
+        while True:
+            try:
+                updates.append(self.status_queue.get_nowait())
+            except Empty:
+                break
+        if not updates:
+            return
+
+        if self.log_file is not None:
+            self.log_file.write(''.join(f"[{status}] {message}\n" for status, message in updates))
+            self.log_file.flush()
+        self.status_log.extend(updates)
+
+        shown = [message + "\n" for status, message in updates[-STATUS_LOG_LINES:] if self.shown_in_log(status)]
+        if not shown:
+            return
+        self.status_text.insert(tk.END, ''.join(shown))
+        # Keep the widget as bounded as the kept lines
+        # 'end-1c' sits on the empty line after the last newline
+        excess = int(self.status_text.index('end-1c').split('.')[0]) - 1 - STATUS_LOG_LINES
+        if excess > 0:
+            self.status_text.delete('1.0', f'{excess + 1}.0')
+        self.status_text.see(tk.END)
+
+    def check_queues(self):
+        try:
+            self.drain_status_queue()
+
+            # Read the progress counters directly; redraw only when they moved
+            if self.progress is not None:
+                current, total = self.progress.snapshot()
+                fraction, files_per_second, eta = self.progress.weighted_snapshot()
+                if total > 0 and (current, fraction) != self.last_progress:  # Prevent division by zero
+                    self.last_progress = (current, fraction)
+                    percentage = fraction * 100
+                    text = f"{current}/{total} files ({percentage:.1f}%) - {files_per_second:.1f} files/s"
+                    if eta is not None and current < total:
+                        text += f", ETA {format_duration(eta)}"
+                    self.total_progress['value'] = percentage
+                    self.progress_text['text'] = text
+
+                # Only rows whose count moved are touched
+                for dir_index, done in enumerate(self.progress.counts):
+                    shown = (done, self.row_errors[dir_index])
+                    if shown != self.row_shown[dir_index]:
+                        self.row_shown[dir_index] = shown
+                        self.update_row(dir_index, done)
+
+        except Exception as e:
+            print(f"Error in check_queues: {str(e)}")
+
+        finally:
+            self.window.after(50, self.check_queues)  # Check more frequently (50ms)
+
+    def update_row(self, dir_index, done=0):
+        total, errors = self.row_totals[dir_index], self.row_errors[dir_index]
+        if done < total:
+            status = "Converting"
+        elif errors:
+            status = f"{errors} errors"
+        else:
+            status = "Done" if total else "Up to date"
+        row = self.active_rows[dir_index]
+        if self.pair_tree.exists(row):
+            self.pair_tree.set(row, 'status', status)
+            self.pair_tree.set(row, 'progress', f"{done}/{total}")
+
+    def start_conversion(self):
+        # Collect directory pairs and count files
+        directory_data = []
+        scans = []
+        total_images = 0
+        total_videos = 0
+        total_other = 0
+        total_done = 0
+        conversion_summary = []
+
+        # Pick up the image output options and remember them for next time
+        self.settings.update({
+            'image_format': self.image_format_var.get(),
+            'image_quality': self.image_quality_var.get(),
+            'png_compress_level': self.png_compress_var.get(),
+            'webp_lossless': self.webp_lossless_var.get(),
+        })
+        save_settings(self.settings)
+        settings = self.settings
+
+        print("\n=== Conversion Summary ===")
+        print("Processing the following directories:\n")
+
+        active_rows = []
+        row_totals = []
+        for row in self.pair_tree.get_children():
+            input_dir = self.directory_pairs[row]['input']
+            output_dir = self.directory_pairs[row]['output']
+            # Imported lists can name folders that are not there (any more)
+            if not os.path.isdir(input_dir):
+                self.pair_tree.set(row, 'status', "Missing input")
+                continue
+
+            if input_dir and output_dir:
+                # Scan the tree once; the conversion reuses the same records
+                records = scan_directory(input_dir, generated_dirs(output_dir, settings))
+                (num_images, num_videos, num_other, image_files, video_files, other_files,
+                 num_done) = get_file_counts(input_dir, output_dir, settings, records)
+                total_images += num_images
+                total_videos += num_videos
+                total_other += num_other
+                total_done += num_done
+
+                # Print directory information
+                print(f"\nInput Directory:  {input_dir}")
+                print(f"Output Directory: {output_dir}")
+                print(f"Files to process:")
+                print(
+                    f"- Images: {num_images} ({', '.join(image_files) if num_images < 6 else ', '.join(image_files[:5]) + '...'})")
+                print(
+                    f"- Videos: {num_videos} ({', '.join(video_files) if num_videos < 6 else ', '.join(video_files[:5]) + '...'})")
+                print(
+                    f"- Other Files: {num_other} ({', '.join(other_files) if num_other < 6 else ', '.join(other_files[:5]) + '...'})")
+                print(f"- Already done: {num_done}")
+                print("-" * 50)
+
+                directory_data.append((input_dir, output_dir))
+                scans.append(records)
+                active_rows.append(row)
+                row_totals.append(num_images + num_videos + num_other)
+                conversion_summary.append({
+                    'input': input_dir,
+                    'output': output_dir,
+                    'images': num_images,
+                    'videos': num_videos,
+                    'other': num_other,
+                    'done': num_done
+                })
+
+        if not directory_data:
+            messagebox.showerror("Error", "No valid directory pairs found")
+            return
+
+        # Fix the total_files calculation to include other files
+        total_files = total_images + total_videos + total_other
+
+        # Print total summary
+        print(f"\nTotal files to convert:")
+        print(f"- Total Images: {total_images}")
+        print(f"- Total Videos: {total_videos}")
+        print(f"- Other Files: {total_other}")
+        print(f"- Grand Total:  {total_files}")
+        print(f"- Already done: {total_done}")
+        print("\n=== End Summary ===\n")
+
+        # Create detailed confirmation message
+        confirm_msg = f"Ready to convert:\n\n"
+        confirm_msg += f"Total Images: {total_images}\n"
+        confirm_msg += f"Total Videos: {total_videos}\n"
+        confirm_msg += f"Other Files: {total_other}\n"
+        confirm_msg += f"Total Files: {total_files} to do / {total_done} already done\n\n"
+        confirm_msg += "Start conversion?"
+
+        # Confirm conversion
+        response = messagebox.askyesno("Confirm Conversion", confirm_msg)
+        if not response:
+            print("Conversion cancelled by user")
+            return
+
+        # Disable all buttons during conversion
+        self.convert_button['state'] = 'disabled'
+        for button in self.pair_buttons:
+            button['state'] = 'disabled'
+
+        # The previous run's counters do not match the new rows
+        self.progress = None
+        self.active_rows = active_rows
+        self.row_totals = row_totals
+        self.row_errors = [0] * len(active_rows)
+        self.row_shown = [(0, 0)] * len(active_rows)
+        for dir_index in range(len(active_rows)):
+            self.update_row(dir_index)
+
+        # Reset and initialize progress bar
+        self.total_progress['value'] = 0
+        self.progress_text['text'] = f"0/{total_files} files"
+
+        print("\nStarting conversion process...")
+
+        # A fresh full log for every run
+        if self.log_file is not None:
+            self.log_file.close()
+        self.log_file = open(LOG_PATH, 'w', encoding='utf-8')
+        self.update_status(f"Full log: {LOG_PATH}")
+
+        def conversion_thread():
+            try:
+                # Process directories concurrently
+                # Results reach the status box as they come in
+                self.process_directories(directory_data, total_files, settings, scans)
+
+                # Clean up output directories
+                print("\nStarting cleanup process...")
+                self.update_status("\nStarting cleanup process...")
+
+                cleanup_results, aae_removed, duplicates_removed = cleanup_all_directories(directory_data)
+                for status, message in cleanup_results:
+                    if status == 'error':
+                        self.update_status(message, status)
+                self.update_status(f"Removed {aae_removed} AAE files and {duplicates_removed} duplicate files")
+
+                # Print completion message
+                print("\nConversion and cleanup completed!")
+                self.update_status("\nConversion and cleanup completed!")
+
+                # Re-enable buttons
+                self.window.after(0, lambda: self.convert_button.configure(state='normal'))
+                for button in self.pair_buttons:
+                    self.window.after(0, lambda b=button: b.configure(state='normal'))
+                self.window.after(0, lambda: messagebox.showinfo("Complete", "All conversions and cleanup completed!"))
+
+            except Exception as e:
+                error_msg = f"Error during conversion: {str(e)}"
+                self.update_status(error_msg, 'error')
+                print(error_msg)
+
+                # Re-enable buttons on error
+                self.window.after(0, lambda: self.convert_button.configure(state='normal'))
+                for button in self.pair_buttons:
+                    self.window.after(0, lambda b=button: b.configure(state='normal'))
+
+        # Start the conversion thread (fixed indentation)
+        threading.Thread(target=conversion_thread, daemon=True).start()
+
+    def run(self):
+        self.window.mainloop()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # Required for Windows executable
+    app = MediaConverterGUI()
+    app.run()
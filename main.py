@@ -1,157 +1,1817 @@
 import os
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from heic2png import HEIC2PNG
+import json
+import shutil
+import sqlite3
+import hashlib
+import subprocess
+import errno
+import io
+import csv
+import bisect
+import tempfile
+import sys
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+from contextlib import contextmanager, nullcontext, redirect_stdout
 import multiprocessing
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import threading
-from queue import Queue, Empty
+from queue import Queue
+from collections import deque
 import time
 
 
-def get_file_counts(input_dir):
-    """Get counts of images and videos in the input directory"""
-    image_ext = ('.HEIC', '.HEIF')
-    heic_files = [f for f in os.listdir(input_dir) if f.endswith(image_ext)]
-    mov_files = [f for f in os.listdir(input_dir) if f.endswith('.MOV')]
-    other_files = [f for f in os.listdir(input_dir) if
-                   not (f.endswith(image_ext) or f.endswith('.MOV') or f.endswith('.AAE'))]
-    return len(heic_files), len(mov_files), len(other_files), heic_files, mov_files, other_files
+CPU_COUNT = os.cpu_count() or 1
+
+# Concurrency limits for each resource class. ffmpeg is multithreaded on its own, so only a
+# few transcodes run at once and together they get about half of the machine.
+FFMPEG_SLOTS = max(1, CPU_COUNT // 8)
+DEFAULT_SETTINGS = {
+    'decode_workers': CPU_COUNT,
+    'ffmpeg_slots': FFMPEG_SLOTS,
+    'ffmpeg_threads': max(2, CPU_COUNT // (2 * FFMPEG_SLOTS)),
+    'io_threads': 4,
+    # Also compare content hashes when deciding whether a source changed since the last run
+    'manifest_hash': False,
+    # 'auto' picks tonemap, sdr or remux per video from its ffprobe info; any of those forces it
+    'video_strategy': 'auto',
+    # How passthrough files reach the output: 'auto' tries a reflink, then an in-kernel copy,
+    # then a plain copy. 'hardlink' and 'symlink' share the input instead of copying it, and
+    # any named strategy falls back along the same chain when it cannot be used.
+    'copy_strategy': 'auto',
+    # Target for converted HEIC/HEIF images: 'png', 'jpeg', 'webp' or 'avif'
+    'image_format': 'png',
+    'png_compress_level': 6,
+    # Quality for JPEG, lossy WebP and AVIF
+    'image_quality': 90,
+    'webp_lossless': False,
+    # Directory to write per-file spans to (spans.jsonl and a Chrome/Perfetto trace.json)
+    'trace_dir': None,
+    # Upper bound in bytes on the estimated memory of all files in flight; None uses half of RAM
+    'memory_budget': None,
+    # Derivatives to produce per source, each a dict with any of 'max_size' (longest edge in
+    # pixels, None keeps the full size), 'subfolder', 'poster' (also write a poster frame of
+    # every video) and the image_* / png_* / webp_* keys above. None is one full-size output.
+    'output_profiles': None,
+    # Videos at least twice this many seconds long are cut at keyframes into segments of about
+    # this length, which idle ffmpeg slots help encode; None encodes every video in one piece
+    'segment_seconds': None,
+    # Directory of a content-addressed cache of converted outputs shared by all output
+    # directories and runs; None turns it off. Outputs come out of it as hardlinks when
+    # cache_link is 'hardlink' (or reflinks/copies where that is not possible).
+    'cache_dir': None,
+    'cache_max_bytes': 10 * 1024 ** 3,
+    'cache_link': 'hardlink',
+    # Seconds a watched file's size and mtime must hold still before it is converted
+    'watch_settle': 2.0,
+}
+
+# Settings saved from the GUI, applied over DEFAULT_SETTINGS
+CONFIG_PATH = os.path.join(os.path.expanduser('~'), '.mass-media-converter.json')
+
+IMAGE_EXTENSIONS = {
+    'png': '.png',
+    'jpeg': '.jpg',
+    'webp': '.webp',
+    'avif': '.avif',
+}
+
+MANIFEST_NAME = '.conversion_manifest.sqlite'
+
+# HDR sources are tonemapped to SDR BT.709 through a 32-bit float pipeline
+VIDEO_FILTER = (
+    'zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,'
+    'tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,'
+    'format=yuv420p'
+)
+# SDR sources only need their pixel format brought to something every player handles
+SDR_VIDEO_FILTER = 'format=yuv420p'
+# Seconds into a video that its poster frame is taken from (at most half its duration)
+POSTER_OFFSET = 1.0
+
+HDR_TRANSFERS = ('smpte2084', 'arib-std-b67')
+# Streams that can be copied into an MP4 as they are
+REMUX_VIDEO_CODECS = ('h264',)
+REMUX_PIXEL_FORMATS = ('yuv420p', 'yuvj420p')
+MP4_AUDIO_CODECS = ('aac', 'mp3', 'alac', 'ac3', 'eac3')
+
+
+# File kinds by lowercase extension; anything else is copied through as 'other'
+FILE_KINDS = {
+    '.heic': 'image',
+    '.heif': 'image',
+    '.mov': 'video',
+    '.aae': 'sidecar',
+}
+
+
+def classify_file(name):
+    """Kind of a file from its extension, ignoring case"""
+    return FILE_KINDS.get(os.path.splitext(name)[1].lower(), 'other')
+
+
+def scan_tree(root, exclude=()):
+    """Walk a directory tree once with os.scandir, yielding a record per file.
+
+    Records carry the path relative to root, the file kind and the stat results, so nothing
+    downstream has to list or stat the tree again. Directories in exclude are not entered.
+    """
+    exclude = {os.path.abspath(path) for path in exclude}
+    pending_dirs = ['']
+    while pending_dirs:
+        rel_dir = pending_dirs.pop()
+        with os.scandir(os.path.join(root, rel_dir)) as entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.abspath(entry.path) not in exclude:
+                        pending_dirs.append(rel_path)
+                    continue
+                # Our own bookkeeping files are never part of the media
+                if not entry.is_file() or entry.name.startswith(MANIFEST_NAME):
+                    continue
+
+                stat = entry.stat()
+                yield {
+                    'file': rel_path,
+                    'kind': classify_file(entry.name),
+                    'input_path': entry.path,
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                }
+
+
+def scan_directory(input_dir, exclude=()):
+    """All file records under input_dir, sorted by relative path"""
+    return sorted(scan_tree(input_dir, exclude), key=lambda record: record['file'])
+
+
+def generated_dirs(output_dir, settings=None):
+    """Directories a conversion into output_dir writes to, which a scan of an input directory
+    holding them must skip so a rerun does not convert its own outputs"""
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    return [path for path in (output_dir, settings['cache_dir'], settings['trace_dir']) if path]
+
+
+def output_profiles(settings):
+    """The output profiles as complete settings dicts, from the largest size to the smallest"""
+    settings = settings or DEFAULT_SETTINGS
+    profiles = [{**settings, 'max_size': None, 'subfolder': '', 'poster': False, **profile}
+                for profile in settings.get('output_profiles') or [{}]]
+    # Each derivative is resized from the previous one, so the chain has to shrink
+    return sorted(profiles, key=lambda profile: -(profile['max_size'] or float('inf')))
+
+
+def profile_path(profile, file, output_dir):
+    extension = IMAGE_EXTENSIONS[profile['image_format']]
+    return os.path.join(output_dir, profile['subfolder'], f"{os.path.splitext(file)[0]}{extension}")
+
+
+def output_paths_for(kind, file, output_dir, settings=None):
+    """Every file a conversion produces: all image derivatives, or a video and its posters"""
+    if kind == 'image':
+        return [profile_path(profile, file, output_dir) for profile in output_profiles(settings)]
+    paths = [output_path_for(kind, file, output_dir, settings)]
+    if kind == 'video':
+        paths += [profile_path(profile, file, output_dir)
+                  for profile in output_profiles(settings) if profile['poster']]
+    return paths
+
+
+def output_path_for(kind, file, output_dir, settings=None):
+    """Where the converted (or copied) version of a source file ends up"""
+    if kind == 'image':
+        # The largest derivative stands for the source in the manifest
+        return output_paths_for(kind, file, output_dir, settings)[0]
+    if kind == 'video':
+        # Ensure output path has .mp4 extension
+        return os.path.join(output_dir, f"{os.path.splitext(file)[0]}.mp4")
+    return os.path.join(output_dir, file)
+
+
+def conversion_params(kind, settings):
+    """The settings that determine what a conversion produces, as stored in the manifest"""
+    if kind == 'image':
+        if not settings.get('output_profiles'):
+            return {'format': settings['image_format'], 'save': image_save_options(settings)}
+        return {'profiles': [{'format': profile['image_format'], 'save': image_save_options(profile),
+                              'max_size': profile['max_size'], 'subfolder': profile['subfolder']}
+                             for profile in output_profiles(settings)]}
+    if kind == 'video':
+        params = {'filter': VIDEO_FILTER, 'sdr_filter': SDR_VIDEO_FILTER, 'crf': 21,
+                  'strategy': settings['video_strategy']}
+        posters = [{'format': profile['image_format'], 'quality': profile['image_quality'],
+                    'max_size': profile['max_size'], 'subfolder': profile['subfolder']}
+                   for profile in output_profiles(settings) if profile['poster']]
+        if posters:
+            params['posters'] = posters
+        return params
+    return {'copy': settings['copy_strategy']}
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's content, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConversionManifest:
+    """Persistent record of converted sources, kept as SQLite in the output directory.
+
+    Each row remembers a source's size, mtime and optionally its content hash together with
+    the output it produced and the parameters used, so later runs only redo files that
+    changed, failed or never finished. Every file a source produced, derivatives included,
+    is also listed against it, so removing any of them as a duplicate can be recorded and
+    the others are still checked for.
+    """
+
+    def __init__(self, output_dir, settings=None):
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'source TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT, '
+            'output TEXT, params TEXT, status TEXT, message TEXT, updated REAL, strategy TEXT)'
+        )
+        # Manifests written before videos had conversion strategies lack that column
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(files)')]
+        if 'strategy' not in columns:
+            self.conn.execute('ALTER TABLE files ADD COLUMN strategy TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_output ON files (output)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, source TEXT, duplicate_of TEXT)'
+        )
+        # Outputs listed before removed ones were told apart lack that column
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(outputs)')]
+        if 'duplicate_of' not in columns:
+            self.conn.execute('ALTER TABLE outputs ADD COLUMN duplicate_of TEXT')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS outputs_source ON outputs (source)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_up_to_date(self, record, output_dir):
+        """Whether a scanned source already has a current output in output_dir"""
+        input_path = record['input_path']
+        source = os.path.abspath(input_path)
+        row = self.conn.execute(
+            'SELECT size, mtime_ns, hash, output, params, status FROM files WHERE source = ?', (source,)
+        ).fetchone()
+        if row is None:
+            return False
+
+        size, mtime_ns, digest, output, params, status = row
+        output_path = output_path_for(record['kind'], record['file'], output_dir, self.settings)
+        if output != output_path:
+            return False
+        if status not in ('success', 'duplicate'):
+            return False
+        # Outputs removed as duplicates of another source's stay done, the rest must be there
+        removed = set()
+        if status == 'duplicate':
+            removed = {path for (path,) in self.conn.execute(
+                'SELECT path FROM outputs WHERE source = ? AND duplicate_of IS NOT NULL', (source,))}
+            # Marked before removed outputs were listed, when only the main output was deduped
+            removed = removed or {os.path.abspath(output)}
+        if not all(os.path.exists(path)
+                   for path in output_paths_for(record['kind'], record['file'], output_dir, self.settings)
+                   if os.path.abspath(path) not in removed):
+            return False
+        if params != json.dumps(conversion_params(record['kind'], self.settings), sort_keys=True):
+            return False
+
+        if record['size'] != size:
+            return False
+        if record['mtime_ns'] == mtime_ns:
+            return True
+
+        # Same size but touched since: only a content hash can tell whether it really changed
+        return bool(self.settings['manifest_hash'] and digest and file_digest(input_path) == digest)
+
+    def record(self, task, status, message):
+        source = os.path.abspath(task['input_path'])
+        output_paths = output_paths_for(task['kind'], task['file'], task['output_dir'], self.settings)
+        # Stat results from the scan: a source modified mid-run is picked up again next time
+        self.conn.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (source, task['size'], task['mtime_ns'], task.get('hash'), output_paths[0],
+             json.dumps(conversion_params(task['kind'], self.settings), sort_keys=True),
+             status, message, time.time(), task.get('strategy'))
+        )
+        self.conn.execute('DELETE FROM outputs WHERE source = ?', (source,))
+        self.conn.executemany('INSERT OR REPLACE INTO outputs VALUES (?, ?, NULL)',
+                              [(os.path.abspath(path), source) for path in output_paths])
+        # Commit every record so a crashed run resumes right where it stopped
+        self.conn.commit()
+
+    def mark_duplicate(self, output_path, original_path):
+        """Note that an output, or a poster or smaller derivative, was removed because it
+        duplicates original_path"""
+        self.conn.execute('UPDATE outputs SET duplicate_of = ? WHERE path = ?',
+                          (original_path, os.path.abspath(output_path)))
+        self.conn.execute(
+            "UPDATE files SET status = 'duplicate', message = ?, updated = ? "
+            "WHERE output = ? OR source IN (SELECT source FROM outputs WHERE path = ?)",
+            (f"Duplicate of {original_path}", time.time(), output_path, os.path.abspath(output_path))
+        )
+        self.conn.commit()
+
+    def output_sources(self):
+        """The absolute path of every listed output, mapped to the source it came from"""
+        return dict(self.conn.execute('SELECT path, source FROM outputs'))
+
+
+def split_pending(records, output_dir=None, settings=None):
+    """Split scanned records into (records still to process, number already done).
+
+    AAE sidecars are never processed. When an output directory is given, files its manifest
+    marks as up to date count as already done.
+    """
+    records = [record for record in records if record['kind'] != 'sidecar']
+    if not output_dir or not os.path.exists(os.path.join(output_dir, MANIFEST_NAME)):
+        return records, 0
+
+    with ConversionManifest(output_dir, settings) as manifest:
+        pending = [record for record in records if not manifest.is_up_to_date(record, output_dir)]
+    return pending, len(records) - len(pending)
+
+
+def get_file_counts(input_dir, output_dir=None, settings=None, records=None):
+    """Get counts of images and videos in the input directory tree.
+
+    Pass the records of an earlier scan_directory call to avoid scanning again. When an
+    output directory is given, files its manifest marks as up to date are left out of the
+    lists and counted as already done instead.
+    """
+    if records is None:
+        records = scan_directory(input_dir, generated_dirs(output_dir, settings))
+    pending, num_done = split_pending(records, output_dir, settings)
+
+    heic_files = [record['file'] for record in pending if record['kind'] == 'image']
+    mov_files = [record['file'] for record in pending if record['kind'] == 'video']
+    other_files = [record['file'] for record in pending if record['kind'] == 'other']
+    return len(heic_files), len(mov_files), len(other_files), heic_files, mov_files, other_files, num_done
+
+
+# Rough processing cost in milliseconds per unit of work. Only the ratios matter: they order
+# the work queue and weight the total progress bar.
+COPY_COST_PER_BYTE = 1e-6
+IMAGE_COST_PER_PIXEL = 8e-5
+VIDEO_COST_PER_PIXEL_FRAME = {
+    'tonemap': 3e-5,
+    'sdr': 5e-6,
+}
+# Used when a file's header cannot be read: a typical HEIC holds about 5 pixels per byte and
+# a typical phone video costs about as much per byte as an SDR re-encode
+IMAGE_PIXELS_PER_BYTE = 5
+VIDEO_COST_PER_BYTE = 2e-4
+
+
+def record_span(task, stage, start, end=None, **extra):
+    """Add a timed span for one stage of a task's processing to task['spans'].
+
+    Times are wall clock seconds so spans from the pool's worker processes line up with the
+    parent's. Spans are tagged with the process and thread that ran them.
+    """
+    task.setdefault('spans', []).append({
+        'task_id': task.get('task_id'),
+        'file': task['file'],
+        'stage': stage,
+        'start': start,
+        'end': time.time() if end is None else end,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        **extra,
+    })
+
+
+@contextmanager
+def span(task, stage):
+    """Time the enclosed block as a span of task"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_span(task, stage, start)
+
+
+def read_image_size(input_path):
+    """(width, height) of a HEIC/HEIF from its header, without decoding the image"""
+    import pillow_heif
+    return pillow_heif.open_heif(input_path).size
+
+
+def plan_video(task, settings):
+    """Probe a video task once and pick its conversion strategy, storing both on the task"""
+    if 'strategy' in task:
+        return
+
+    strategy = settings['video_strategy']
+    try:
+        with span(task, 'probe'):
+            probe = probe_video(task['input_path'])
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        # Without stream information the full tonemap chain is the safe choice
+        probe = {}
+        if strategy == 'auto':
+            strategy = 'tonemap'
+    if strategy == 'auto':
+        strategy = choose_video_strategy(probe)
+    task['probe'] = probe
+    task['strategy'] = strategy
+
+
+# Rough peak memory per file. Images hold the input, the decoded RGB pixels, a converted copy
+# and the encoded output at once. Video encoders keep a lookahead of 4:2:0 frames, and the
+# tonemap chain adds float32 RGB frames for each filter thread.
+IMAGE_BYTES_PER_PIXEL = 3 * 2.5
+VIDEO_LOOKAHEAD_FRAMES = 48
+VIDEO_BYTES_PER_PIXEL = 1.5
+TONEMAP_BYTES_PER_PIXEL = 12
+FFMPEG_BASE_MEMORY = 64 * 1024 * 1024
+COPY_MEMORY = 16 * 1024 * 1024
+# Used when an image's header cannot be read: 48 MP
+FALLBACK_IMAGE_PIXELS = 48_000_000
+
+
+def estimate_footprint(task, settings):
+    """Rough peak memory in bytes of processing a task, from its header dimensions"""
+    if task['kind'] == 'image':
+        return task['size'] + (task.get('pixels') or FALLBACK_IMAGE_PIXELS) * IMAGE_BYTES_PER_PIXEL
+
+    if task['kind'] == 'video':
+        probe = task.get('probe', {})
+        pixels = (probe.get('width') or 3840) * (probe.get('height') or 2160)
+        if task.get('strategy') == 'remux':
+            return FFMPEG_BASE_MEMORY
+        footprint = FFMPEG_BASE_MEMORY + pixels * VIDEO_BYTES_PER_PIXEL * VIDEO_LOOKAHEAD_FRAMES
+        if task.get('strategy') != 'sdr':
+            footprint += pixels * TONEMAP_BYTES_PER_PIXEL * 2 * settings['ffmpeg_threads']
+        if probe and segmented(task, settings):
+            # Up to every ffmpeg slot may end up encoding one of its segments
+            footprint *= max(1, min(settings['ffmpeg_slots'], int(probe['duration'] // settings['segment_seconds'])))
+        return footprint
+
+    return COPY_MEMORY
+
+
+def default_memory_budget():
+    """Half of physical memory, or 4 GB where that cannot be determined"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 ** 3
+
+
+def estimate_cost(task, settings):
+    """Rough estimate in milliseconds of how expensive a file is to process.
+
+    Images are weighted by pixel count from their header and videos by duration times
+    resolution for the strategy they will use; copies and remuxes by size.
+    """
+    kind, size = task['kind'], max(task['size'], 1)
+    if kind == 'image':
+        try:
+            width, height = read_image_size(task['input_path'])
+        except Exception:
+            return size * IMAGE_PIXELS_PER_BYTE * IMAGE_COST_PER_PIXEL
+        task['pixels'] = width * height
+        return width * height * IMAGE_COST_PER_PIXEL
+
+    if kind == 'video':
+        plan_video(task, settings)
+        probe = task['probe']
+        if task['strategy'] == 'remux':
+            return size * COPY_COST_PER_BYTE
+        if not (probe.get('width') and probe.get('height') and probe.get('duration')):
+            return size * VIDEO_COST_PER_BYTE
+        frames = probe.get('frames') or probe['duration'] * 30
+        return probe['width'] * probe['height'] * frames * VIDEO_COST_PER_PIXEL_FRAME[task['strategy']]
+
+    return size * COPY_COST_PER_BYTE
+
+
+def build_file_tasks(directory_data, settings=None, scans=None):
+    """Break every directory pair into per-file tasks, most expensive first.
+
+    scans optionally holds the scan_directory records for each pair, in the same order, so
+    trees that were already scanned for counting are not walked again. Files the output
+    directory's manifest marks as up to date are skipped. With the output cache on, sources
+    to convert are hashed here so identical ones can be told apart before any runs.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    tasks = []
+    for dir_index, (input_dir, output_dir) in enumerate(directory_data):
+        records = scans[dir_index] if scans is not None else scan_tree(input_dir, generated_dirs(output_dir, settings))
+        pending, _ = split_pending(records, output_dir, settings)
+        for record in pending:
+            tasks.append({
+                **record,
+                'dir_index': dir_index,
+                'output_dir': output_dir,
+            })
+
+    def prepare(task):
+        if settings['cache_dir'] and task['kind'] != 'other':
+            with span(task, 'hash'):
+                task['hash'] = file_digest(task['input_path'])
+            task['cache_key'] = OutputCache.key(task, settings)
+        return estimate_cost(task, settings)
+
+    # Reading headers, probing videos and hashing are I/O bound, so they run on a thread pool
+    with ThreadPool(settings['io_threads']) as pool:
+        costs = pool.map(prepare, tasks)
+    for task, cost in zip(tasks, costs):
+        task['cost'] = cost
+        task['footprint'] = estimate_footprint(task, settings)
+
+    # Largest videos first so the long jobs never end up running alone at the end
+    tasks.sort(key=lambda task: task['cost'], reverse=True)
+    for task_id, task in enumerate(tasks):
+        task['task_id'] = task_id
+    return tasks
+
+
+def load_settings(path=CONFIG_PATH):
+    """DEFAULT_SETTINGS with the values saved in the config file applied over them"""
+    settings = dict(DEFAULT_SETTINGS)
+    if os.path.exists(path):
+        with open(path) as f:
+            settings.update(json.load(f))
+    return settings
+
+
+def save_settings(settings, path=CONFIG_PATH):
+    """Write the settings that differ from DEFAULT_SETTINGS to the config file"""
+    changed = {key: value for key, value in settings.items() if DEFAULT_SETTINGS.get(key) != value}
+    with open(path, 'w') as f:
+        json.dump(changed, f, indent=4, sort_keys=True)
+
+
+def image_save_options(settings):
+    """Pillow save() arguments for the configured image format"""
+    image_format = settings['image_format']
+    if image_format == 'png':
+        return {'compress_level': settings['png_compress_level']}
+    if image_format == 'webp' and settings['webp_lossless']:
+        return {'lossless': True}
+    if image_format in IMAGE_EXTENSIONS:
+        return {'quality': settings['image_quality']}
+    raise ValueError(f"Unsupported image format: {image_format}")
+
+
+def fit_size(size, max_size):
+    """size scaled down to fit a max_size square, keeping the aspect ratio"""
+    width, height = size
+    scale = max_size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode_image(img, output_path, settings):
+    """Encode a decoded image to output_path (a path or file object) in the configured format"""
+    image_format = settings['image_format']
+    options = image_save_options(settings)
+    # Carry the color profile and camera metadata over to the output
+    for key in ('icc_profile', 'exif'):
+        if img.info.get(key):
+            options[key] = img.info[key]
+    if image_format == 'jpeg' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img.save(output_path, format=image_format.upper(), **options)
+
+
+def convert_image(task, settings, report=None):
+    # Imported here so runs without images, and the CLI's startup, never load the codecs
+    from PIL import Image
+    import pillow_heif
+
+    profiles = output_profiles(settings)
+    pillow_heif.register_heif_opener()
+
+    # Read, decode, encode and write are kept apart so each gets its own span
+    with span(task, 'read'):
+        with open(task['input_path'], 'rb') as f:
+            data = f.read()
+
+    # Decode once, then encode to the target format
+    start = time.time()
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    record_span(task, 'decode', start)
+    decode_time = time.time() - start
+
+    # Every derivative comes from the same decoded image, each resized from the one before
+    encode_time = 0.0
+    output_size = 0
+    for profile in profiles:
+        max_size = profile['max_size']
+        if max_size and max(img.size) > max_size:
+            with span(task, 'resize'):
+                img = img.resize(fit_size(img.size, max_size), Image.LANCZOS)
+
+        start = time.time()
+        encoded = io.BytesIO()
+        encode_image(img, encoded, profile)
+        record_span(task, 'encode', start, format=profile['image_format'])
+        encode_time += time.time() - start
+
+        # The manifest decides what needs redoing, so stale outputs are overwritten
+        output_path = profile_path(profile, task['file'], task['output_dir'])
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with span(task, 'write'):
+            with open(output_path, 'wb') as f:
+                f.write(encoded.getbuffer())
+        output_size += encoded.getbuffer().nbytes
+
+    task['decode_time'] = decode_time
+    task['encode_time'] = encode_time
+    task['output_size'] = output_size
+    formats = ', '.join(profile['image_format'] if not profile['max_size'] else
+                        f"{profile['image_format']} {profile['max_size']}px" for profile in profiles)
+    return (f"Converted image: {task['file']} ({formats}, "
+            f"{task['output_size'] / 1024 / 1024:.2f} MB, decode {decode_time:.2f}s, encode {encode_time:.2f}s)")
+
+
+def probe_video(input_path):
+    """Codec and color information of a video's streams, from ffprobe's JSON output"""
+    completed = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', input_path],
+        capture_output=True, text=True, check=True
+    )
+    info = json.loads(completed.stdout)
+    streams = info.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+
+    return {
+        'video_codec': video.get('codec_name'),
+        'pix_fmt': video.get('pix_fmt'),
+        'color_transfer': video.get('color_transfer'),
+        'color_primaries': video.get('color_primaries'),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'duration': float(info.get('format', {}).get('duration') or 0),
+        'frames': int(video.get('nb_frames') or 0),
+        'audio_codecs': [stream.get('codec_name') for stream in streams if stream.get('codec_type') == 'audio'],
+    }
+
+
+def choose_video_strategy(probe):
+    """'tonemap' for HDR sources, 'remux' when the video stream fits an MP4 as is, else 'sdr'"""
+    if probe['color_transfer'] in HDR_TRANSFERS or probe['color_primaries'] == 'bt2020':
+        return 'tonemap'
+    if probe['video_codec'] in REMUX_VIDEO_CODECS and probe['pix_fmt'] in REMUX_PIXEL_FORMATS:
+        return 'remux'
+    return 'sdr'
+
+
+def video_command(strategy, input_path, output_path, probe, settings, file=None, output_dir=None):
+    """ffmpeg arguments that convert input_path to output_path with the given strategy,
+    plus a poster frame for each poster profile (which needs file and output_dir)"""
+    command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1',
+               '-i', input_path]
+    command += video_arguments(strategy, settings) + audio_arguments(probe) + [output_path]
+    return command + poster_outputs(strategy, probe, settings, file, output_dir)
+
+
+def video_arguments(strategy, settings):
+    """ffmpeg output arguments for the video stream of a strategy"""
+    if strategy == 'remux':
+        return ['-c:v', 'copy']
+    if strategy == 'tonemap':
+        arguments = ['-vf', VIDEO_FILTER, '-x264-params', 'colormatrix=bt709']
+    else:
+        arguments = ['-vf', SDR_VIDEO_FILTER]
+    return arguments + ['-c:v', 'libx264', '-crf', '21', '-threads', str(settings['ffmpeg_threads'])]
+
+
+def audio_arguments(probe):
+    # Audio is copied unless the MP4 container cannot hold it
+    audio_copy = all(codec in MP4_AUDIO_CODECS for codec in probe.get('audio_codecs', []))
+    return ['-c:a', 'copy' if audio_copy else 'aac']
+
+
+def poster_outputs(strategy, probe, settings, file, output_dir, input_index=0):
+    # Posters are further outputs of the same run, so the source is only read and decoded once
+    arguments = []
+    for profile in output_profiles(settings):
+        if profile['poster']:
+            arguments += poster_arguments(strategy, probe, profile, profile_path(profile, file, output_dir),
+                                          input_index)
+    return arguments
+
+
+def poster_arguments(strategy, probe, profile, poster_path, input_index=0):
+    """ffmpeg output arguments that write one frame of the first video stream of an input
+    as a poster"""
+    # Posters are always SDR, so HDR sources are tonemapped even when the video is remuxed
+    hdr = strategy == 'tonemap' or (strategy == 'remux' and probe.get('color_transfer') in HDR_TRANSFERS)
+    video_filter = VIDEO_FILTER if hdr else SDR_VIDEO_FILTER
+    if profile['max_size']:
+        size = profile['max_size']
+        video_filter += (f",scale=w='min(iw,{size})':h='min(ih,{size})'"
+                         f":force_original_aspect_ratio=decrease")
+    # A frame a little way in is more representative than the often dark first one
+    offset = min(POSTER_OFFSET, (probe.get('duration') or 0) / 2)
+    arguments = ['-map', f'{input_index}:v:0', '-an', '-ss', f'{offset:.3f}', '-vf', video_filter, '-frames:v', '1']
+
+    image_format = profile['image_format']
+    if image_format == 'jpeg':
+        # qscale runs from 2 (best) to 31 (worst)
+        arguments += ['-q:v', str(max(2, min(31, round(31 - profile['image_quality'] * 0.29))))]
+    elif image_format == 'webp':
+        arguments += ['-lossless', '1'] if profile['webp_lossless'] else ['-quality', str(profile['image_quality'])]
+    elif image_format == 'png':
+        arguments += ['-compression_level', str(profile['png_compress_level'])]
+    return arguments + ['-update', '1', poster_path]
+
+
+def run_ffmpeg(command, probe, report=None, task=None):
+    """Run an ffmpeg command that writes -progress to stdout, reporting the fraction done.
+
+    The fraction comes from the frame count when ffprobe knew the total number of frames,
+    otherwise from out_time against the duration. Returns ffmpeg's exit status. With a task,
+    a 'subprocess' span with ffmpeg's wall and CPU time is recorded on it.
+    """
+    total_frames = probe.get('frames')
+    duration = probe.get('duration')
+
+    start = time.time()
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            if report is None or value in ('', 'N/A'):
+                continue
+            if key == 'frame' and total_frames:
+                report(int(value) / total_frames)
+            elif key == 'out_time_us' and duration and not total_frames:
+                report(int(value) / 1e6 / duration)
+            elif key == 'progress' and value == 'end':
+                report(1.0)
+
+        if not hasattr(os, 'wait4'):
+            exit_status = process.wait()
+            cpu = None
+        else:
+            # Reap this one child ourselves to get its own resource usage
+            _, wait_status, usage = os.wait4(process.pid, 0)
+            process.returncode = exit_status = os.waitstatus_to_exitcode(wait_status)
+            cpu = usage.ru_utime + usage.ru_stime
+
+    if task is not None:
+        record_span(task, 'subprocess', start, cpu=cpu)
+    return exit_status
+
+
+def convert_video(task, settings, report=None, segment_pool=None):
+    output_path = output_path_for('video', task['file'], task['output_dir'])
+    plan_video(task, settings)
+    strategy = task['strategy']
+
+    for path in output_paths_for('video', task['file'], task['output_dir'], settings)[1:]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if segmented(task, settings):
+        num_segments = convert_video_segments(task, settings, output_path, report, segment_pool)
+        if num_segments:
+            return f"Converted video ({strategy}, {num_segments} segments): {task['file']}"
+
+    # A failed transcode must not be recorded as done in the manifest
+    command = video_command(strategy, task['input_path'], output_path, task['probe'], settings,
+                            task['file'], task['output_dir'])
+    exit_status = run_ffmpeg(command, task['probe'], report, task)
+    if exit_status != 0:
+        raise RuntimeError(f"ffmpeg ({strategy}) exited with status {exit_status}")
+    return f"Converted video ({strategy}): {task['file']}"
+
+
+def segmented(task, settings):
+    """Whether a video is long enough to be encoded in segments, when that is turned on"""
+    segment_seconds = settings['segment_seconds']
+    return bool(segment_seconds and task['strategy'] != 'remux'
+                and task['probe'].get('duration', 0) >= 2 * segment_seconds)
+
+
+# Seconds before a segment's keyframe that its ffmpeg seeks to, well under any frame interval
+SEGMENT_SEEK_MARGIN = 0.001
+
+
+def plan_segments(input_path, segment_seconds):
+    """Where to cut a video for encoding it in pieces: a (start, frames) pair per piece.
+
+    Every piece starts on a keyframe at least segment_seconds after the previous piece's
+    start. Frames are counted by presentation time from the packet list, without decoding.
+    """
+    completed = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+         '-print_format', 'csv=print_section=0', input_path],
+        capture_output=True, text=True, check=True
+    )
+    packets = []
+    for line in completed.stdout.splitlines():
+        pts_time, flags = line.split(',')[:2]
+        if pts_time != 'N/A':
+            packets.append((float(pts_time), 'K' in flags))
+    if not packets:
+        return []
+    packets.sort()
+
+    starts = [packets[0][0]]
+    for pts_time, keyframe in packets:
+        if keyframe and pts_time - starts[-1] >= segment_seconds:
+            starts.append(pts_time)
+    frames = [0] * len(starts)
+    for pts_time, _ in packets:
+        frames[bisect.bisect_right(starts, pts_time) - 1] += 1
+    # Seeks are relative to the start of the file
+    return [(start - starts[0], count) for start, count in zip(starts, frames)]
+
+
+def count_video_frames(path):
+    """(frames, duration) of the first video stream, counting its packets rather than trusting
+    the container's header"""
+    completed = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+         '-show_entries', 'stream=nb_read_packets,duration', '-print_format', 'json', path],
+        capture_output=True, text=True, check=True
+    )
+    stream = json.loads(completed.stdout)['streams'][0]
+    return int(stream['nb_read_packets']), float(stream.get('duration') or 0)
+
+
+def convert_video_segments(task, settings, output_path, report=None, segment_pool=None):
+    """Encode a long video as keyframe-aligned segments, in parallel where ffmpeg slots are
+    idle, then join them.
+
+    The calling thread works through the segments itself. When given the ffmpeg pool it runs
+    on as segment_pool, helpers queued on that pool take segments too as soon as a slot frees
+    up, so the video never runs more ffmpegs than the slots it gets.
+
+    Every segment is decoded from the source starting at its keyframe, gets the strategy's
+    filter and encode on its own ffmpeg and stops after exactly its own frames. Stream
+    copying the pieces apart instead would lose the leading B-frames of open GOPs at every
+    cut. The encoded pieces are concatenated without re-encoding, the audio is muxed in once
+    from the source, and posters are taken from the source in the same run.
+
+    Returns the number of segments, or 0 when the video has too few keyframes to split or
+    the joined video does not have the source's frame count and duration, in which case
+    the caller encodes it in one piece.
+    """
+    strategy, probe = task['strategy'], task['probe']
+    with span(task, 'split'):
+        segments = plan_segments(task['input_path'], settings['segment_seconds'])
+    if len(segments) < 2:
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix='.segments-', dir=os.path.dirname(output_path)) as segment_dir:
+        # Each segment's share of the video, for reporting progress across all of them
+        total = sum(frames for _, frames in segments)
+        fractions = [0.0] * len(segments)
+
+        def encode(index):
+            start, frames = segments[index]
+            encoded_path = os.path.join(segment_dir, f"encoded_{index:05d}.mp4")
+            # Seek a hair early so rounding in the printed timestamp cannot drop the keyframe
+            command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1',
+                       '-ss', f'{max(0.0, start - SEGMENT_SEEK_MARGIN):.6f}', '-i', task['input_path'],
+                       '-map', '0:v:0', '-frames:v', str(frames)]
+            command += video_arguments(strategy, settings) + ['-an', encoded_path]
+
+            def report_segment(fraction):
+                fractions[index] = fraction * frames / total
+                if report is not None:
+                    report(sum(fractions))
+
+            exit_status = run_ffmpeg(command, {'frames': frames}, report_segment, task)
+            if exit_status != 0:
+                raise RuntimeError(f"ffmpeg ({strategy}) exited with status {exit_status} on segment {index}")
+            return encoded_path
+
+        # Segments not yet taken, and how many taken ones are still encoding
+        unclaimed = deque(range(len(segments)))
+        encoded_paths = [None] * len(segments)
+        errors = []
+        encoding = threading.Condition()
+        running = [0]
+
+        def encode_unclaimed():
+            while True:
+                with encoding:
+                    if not unclaimed or errors:
+                        return
+                    index = unclaimed.popleft()
+                    running[0] += 1
+                try:
+                    encoded_paths[index] = encode(index)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    with encoding:
+                        running[0] -= 1
+                        encoding.notify_all()
+
+        if segment_pool is not None:
+            # A helper that only gets a slot after the last segment was taken returns at once
+            for _ in range(min(settings['ffmpeg_slots'], len(segments)) - 1):
+                segment_pool.apply_async(encode_unclaimed)
+        encode_unclaimed()
+        with encoding:
+            encoding.wait_for(lambda: not running[0])
+        if errors:
+            raise errors[0]
+
+        list_path = os.path.join(segment_dir, 'encoded.txt')
+        with open(list_path, 'w') as f:
+            f.writelines(f"file '{os.path.basename(path)}'\n" for path in encoded_paths)
+        command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1',
+                   '-f', 'concat', '-safe', '0', '-i', list_path, '-i', task['input_path'],
+                   '-map', '0:v', '-map', '1:a?', '-c:v', 'copy'] + audio_arguments(probe) + [output_path]
+        command += poster_outputs(strategy, probe, settings, task['file'], task['output_dir'], input_index=1)
+        with span(task, 'concat'):
+            exit_status = run_ffmpeg(command, probe)
+        if exit_status != 0:
+            raise RuntimeError(f"ffmpeg (concat) exited with status {exit_status}")
+
+    # A seam that dropped or duplicated frames shows up in the frame count or the duration
+    with span(task, 'verify'):
+        source_frames, source_duration = count_video_frames(task['input_path'])
+        output_frames, output_duration = count_video_frames(output_path)
+    frame_duration = source_duration / max(source_frames, 1)
+    if output_frames != source_frames or abs(output_duration - source_duration) > frame_duration:
+        print(f"Segmented encode of {task['file']} has {output_frames} frames over {output_duration:.3f}s "
+              f"instead of {source_frames} over {source_duration:.3f}s, encoding it in one piece")
+        return 0
+    return len(segments)
+
+
+# FICLONE ioctl from linux/fs.h: share the source's extents on btrfs, XFS and other CoW filesystems
+FICLONE = 0x40049409
+
+# Errors meaning "this strategy does not work here", as opposed to a real I/O failure
+UNSUPPORTED_COPY_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS,
+                           errno.ENOTTY, errno.EPERM, errno.EBADF)
+
+
+def reflink_copy(input_path, output_path):
+    import fcntl
+    with open(input_path, 'rb') as source, open(output_path, 'wb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+def kernel_copy(copy_function, input_path, output_path):
+    """Copy a file with an in-kernel primitive taking (out_fd, in_fd, count) style chunks"""
+    with open(input_path, 'rb') as source, open(output_path, 'wb') as target:
+        remaining = os.fstat(source.fileno()).st_size
+        while remaining > 0:
+            copied = copy_function(source.fileno(), target.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def copy_file_range_copy(input_path, output_path):
+    kernel_copy(lambda in_fd, out_fd, count: os.copy_file_range(in_fd, out_fd, count), input_path, output_path)
+
+
+def sendfile_copy(input_path, output_path):
+    kernel_copy(lambda in_fd, out_fd, count: os.sendfile(out_fd, in_fd, None, count), input_path, output_path)
+
+
+def hardlink_copy(input_path, output_path):
+    if os.stat(input_path).st_dev != os.stat(os.path.dirname(output_path)).st_dev:
+        raise OSError(errno.EXDEV, "Input and output are on different filesystems")
+    os.link(input_path, output_path)
+
+
+def symlink_copy(input_path, output_path):
+    if os.stat(input_path).st_dev != os.stat(os.path.dirname(output_path)).st_dev:
+        raise OSError(errno.EXDEV, "Input and output are on different filesystems")
+    os.symlink(os.path.abspath(input_path), output_path)
+
+
+def plain_copy(input_path, output_path):
+    shutil.copyfile(input_path, output_path)
+
+
+# name -> (function, whether the output is a new file that should get the input's metadata)
+COPY_STRATEGIES = {
+    'reflink': (reflink_copy, True),
+    'copy_file_range': (copy_file_range_copy, True),
+    'sendfile': (sendfile_copy, True),
+    'hardlink': (hardlink_copy, False),
+    'symlink': (symlink_copy, False),
+    'copy': (plain_copy, True),
+}
+AUTO_COPY_CHAIN = ('reflink', 'copy_file_range', 'sendfile', 'copy')
+
+# First strategy that worked for each (input device, output device, configured strategy), so
+# unsupported ones are only tried once per filesystem pair
+working_copy_strategies = {}
+
+
+def copy_chain(strategy):
+    if strategy == 'auto':
+        return AUTO_COPY_CHAIN
+    return (strategy,) + tuple(name for name in AUTO_COPY_CHAIN if name != strategy)
+
+
+def passthrough_copy(input_path, output_path, strategy='auto'):
+    """Copy a file with the best strategy that works here, returning the one used"""
+    key = (os.stat(input_path).st_dev, os.stat(os.path.dirname(output_path)).st_dev, strategy)
+    chain = copy_chain(strategy)
+    if key in working_copy_strategies:
+        chain = chain[chain.index(working_copy_strategies[key]):]
 
+    for name in chain:
+        copy_function, copy_metadata = COPY_STRATEGIES[name]
+        # Links cannot replace an existing output, and a stale one must not survive a fallback
+        if os.path.lexists(output_path):
+            os.remove(output_path)
+        try:
+            copy_function(input_path, output_path)
+        except AttributeError:
+            continue  # Not available on this platform
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_COPY_ERRORS or name == 'copy':
+                raise
+            continue
 
-def convert_directory(input_dir, output_dir, progress_dict, dir_index):
-    """Enhanced function for directory conversion with file management"""
-    results = []
+        working_copy_strategies[key] = name
+        if copy_metadata:
+            shutil.copystat(input_path, output_path)  # Preserve metadata like copy2 did
+        return name
+
+    raise OSError(f"No copy strategy worked for {input_path}")
+
+
+def copy_file(task, settings, report=None):
+    output_path = output_path_for('other', task['file'], task['output_dir'])
+    with span(task, 'copy'):
+        strategy = passthrough_copy(task['input_path'], output_path, settings['copy_strategy'])
+    task['strategy'] = strategy
+    return f"Copied file ({strategy}): {task['file']}"
+
+
+class OutputCache:
+    """Content-addressed store of converted outputs, shared by every output directory.
+
+    Entries are keyed by the source's SHA-256 together with the conversion parameters, so
+    the same photo found in several input folders, or again in a later run, is converted
+    once and then linked or reflinked into each output directory. An SQLite index tracks
+    each entry's size and last use, and the least recently used entries are evicted once
+    the cache grows past its size cap.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        # Pool workers in several processes share the index, so wait on each other's writes
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, files TEXT, size INTEGER, last_used REAL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(task, settings):
+        params = json.dumps(conversion_params(task['kind'], settings), sort_keys=True)
+        return hashlib.sha256(f"{task['kind']}\0{task['hash']}\0{params}".encode()).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, 'objects', key[:2], key)
+
+    def fetch(self, key, output_paths, strategy):
+        """Materialize a cached entry at output_paths, returning the copy strategy used, or
+        None when the entry is missing or incomplete"""
+        with self.lock:
+            row = self.conn.execute('SELECT files FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        files = json.loads(row[0])
+        sources = [os.path.join(self.entry_dir(key), name) for name in files]
+        if len(files) != len(output_paths) or not all(os.path.exists(path) for path in sources):
+            self.remove(key)
+            return None
+
+        used = None
+        try:
+            for source, output_path in zip(sources, output_paths):
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                used = passthrough_copy(source, output_path, strategy)
+        except FileNotFoundError:
+            return None  # Evicted by another worker meanwhile
+        with self.lock:
+            self.conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        return used
+
+    def store(self, key, output_paths):
+        """Add freshly converted outputs as the entry for key, then evict down to the size cap"""
+        entry_dir = self.entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        files = []
+        for index, output_path in enumerate(output_paths):
+            name = f"{index}{os.path.splitext(output_path)[1]}"
+            # Copied in under a temporary name so a concurrent fetch never sees half a file.
+            # Not a hardlink: editing an output in place must not change the cached copy.
+            # Converting the source again cannot either, convert_file unlinks old outputs first.
+            partial_path = os.path.join(entry_dir, f".{name}.{os.getpid()}.{threading.get_ident()}")
+            passthrough_copy(output_path, partial_path)
+            os.replace(partial_path, os.path.join(entry_dir, name))
+            files.append(name)
+
+        size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in files)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                              (key, json.dumps(files), size, time.time()))
+            self.conn.commit()
+        self.evict()
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(self.entry_dir(key)))
+        except OSError:
+            pass  # Other entries share the prefix directory
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.conn.commit()
+
+    def evict(self):
+        """Drop the least recently used entries until the cache fits in max_bytes"""
+        with self.lock:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            oldest = self.conn.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall()
+        for key, size in oldest:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+
+# One OutputCache per process and cache directory, opened on first use (an SQLite
+# connection must not be carried over into a forked worker)
+open_caches = {}
+open_caches_lock = threading.Lock()
+
+
+def output_cache(settings):
+    """The OutputCache for the configured cache_dir, or None when caching is off"""
+    cache_dir = settings.get('cache_dir')
+    if not cache_dir:
+        return None
+    key = (os.getpid(), cache_dir)
+    with open_caches_lock:
+        if key not in open_caches:
+            open_caches[key] = OutputCache(cache_dir, settings['cache_max_bytes'])
+        return open_caches[key]
+
+
+class CacheStats:
+    """Hits and misses of the output cache over a run, from the finished tasks"""
 
-    # Get file counts
-    image_ext = ('.HEIC', '.HEIF')
-    heic_files = [f for f in os.listdir(input_dir) if f.endswith(image_ext)]
-    mov_files = [f for f in os.listdir(input_dir) if f.endswith('.MOV')]
-    other_files = [f for f in os.listdir(input_dir) if
-                   not (f.endswith(image_ext) or f.endswith('.MOV') or f.endswith('.AAE'))]
+    def __init__(self):
+        self.counts = {'hit': 0, 'miss': 0}
+        self.bytes_reused = 0
+
+    def add(self, task):
+        outcome = task.get('cache')
+        if outcome in self.counts:
+            self.counts[outcome] += 1
+            if outcome == 'hit':
+                self.bytes_reused += task.get('output_size', 0)
+
+    def print_summary(self):
+        lookups = self.counts['hit'] + self.counts['miss']
+        if not lookups:
+            return
+        print("\n=== Output Cache Summary ===")
+        print(f"- Hits: {self.counts['hit']} ({self.counts['hit'] / lookups:.1%})")
+        print(f"- Misses: {self.counts['miss']}")
+        print(f"- Reused: {self.bytes_reused / 1024 / 1024:.2f} MB")
+        print("=== End Output Cache Summary ===\n")
+
+
+FILE_HANDLERS = {
+    'image': (convert_image, "Error converting"),
+    'video': (convert_video, "Error converting"),
+    'other': (copy_file, "Error copying"),
+}
+
+# Which pool each kind of file runs on
+RESOURCE_CLASSES = {
+    'image': 'decode',
+    'video': 'ffmpeg',
+    'other': 'io',
+}
+
+
+def convert_file(task, settings=None, report=None, segment_pool=None):
+    """Process a single file task, returning (task, status, message).
+
+    report, when given, is called with the fraction of the file done so far by handlers
+    that can tell, such as ffmpeg transcodes. segment_pool is the ffmpeg pool a video runs
+    on, which lets a segmented encode hand segments to idle slots.
+    """
+    settings = settings or DEFAULT_SETTINGS
+    handler, error_prefix = FILE_HANDLERS[task['kind']]
+    if 'submitted' in task:
+        record_span(task, 'queue', task['submitted'])
+    try:
+        # Copies gain nothing from the cache, conversions do
+        cache = output_cache(settings) if task['kind'] != 'other' else None
+        if (settings['manifest_hash'] or cache is not None) and 'hash' not in task:
+            with span(task, 'hash'):
+                task['hash'] = file_digest(task['input_path'])
+        # Mirror the input tree's subfolders in the output directory
+        output_path = output_path_for(task['kind'], task['file'], task['output_dir'], settings)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        if cache is not None:
+            key = task.get('cache_key') or cache.key(task, settings)
+            output_paths = output_paths_for(task['kind'], task['file'], task['output_dir'], settings)
+            with span(task, 'cache'):
+                strategy = cache.fetch(key, output_paths, settings['cache_link'])
+            if strategy is not None:
+                task['cache'] = 'hit'
+                task['output_size'] = sum(os.path.getsize(path) for path in output_paths)
+                task['finished'] = time.time()
+                return task, "success", f"Reused cached {task['kind']} ({strategy}): {task['file']}"
+            task['cache'] = 'miss'
+
+        # An earlier cache hit may have left the outputs as hardlinks to cache objects, and
+        # writing through one would change the cached copy and every output linked to it
+        for path in output_paths_for(task['kind'], task['file'], task['output_dir'], settings):
+            if os.path.lexists(path):
+                os.remove(path)
+        if segment_pool is not None:
+            message = handler(task, settings, report, segment_pool)
+        else:
+            message = handler(task, settings, report)
+        if cache is not None:
+            with span(task, 'cache'):
+                cache.store(key, output_paths)
+        task['finished'] = time.time()
+        return task, "success", message
+    except Exception as e:
+        task['finished'] = time.time()
+        return task, "error", f"{error_prefix} {task['file']}: {str(e)}"
+
+
+def hold_duplicates(tasks, waiting):
+    """The tasks to start now, holding back each one whose output cache key is already taken
+    by an earlier task in waiting[key], so identical sources are not converted side by side"""
+    ready = []
+    for task in tasks:
+        key = task.get('cache_key')
+        if key is None:
+            ready.append(task)
+        elif key in waiting:
+            waiting[key].append(task)
+        else:
+            waiting[key] = deque()
+            ready.append(task)
+    return ready
+
+
+def release_duplicates(task, status, waiting):
+    """The tasks held back behind a finished task: all of them once its outputs are in the
+    cache to be reused, or the next one to try converting again when it failed"""
+    key = task.get('cache_key')
+    if key not in waiting:
+        return []
+    held = waiting[key]
+    if status == 'success' or not held:
+        del waiting[key]
+        return list(held)
+    return [held.popleft()]
+
+
+class ResourceExecutor:
+    """Runs file tasks on a separate, independently sized pool per resource class.
+
+    HEIC decodes run in worker processes, ffmpeg transcodes run from a few threads that each
+    wait on their own ffmpeg process, and plain copies run on an I/O thread pool. Completions
+    from all three pools come back through one queue in the order they finish. Tasks running
+    on threads report their partial progress straight into the progress counters.
+
+    Tasks are handed to the pools in the order they were queued (most expensive first), but
+    only while the estimated memory of everything in flight stays under the memory budget.
+    When the next file does not fit, smaller ones that do are admitted ahead of it, so small
+    files keep every core busy while big ones wait their turn.
+
+    Sources sharing an output cache key are converted once, and the others only start after
+    that one finished, to be materialized from the cache.
+    """
+
+    def __init__(self, settings=None, progress=None):
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.progress = progress
+        self.completed = Queue()
+        self.pools = {}
+        self.memory_budget = self.settings['memory_budget'] or default_memory_budget()
+        self.memory_in_flight = 0
+        # Pending tasks in the order given, each also in a bucket by the power of two of its
+        # footprint so finding the largest ones that fit never scans the whole queue. Both hold
+        # the same one-item lists, emptied once the task is submitted and dropped when met.
+        self.queue = deque()
+        self.buckets = {}
+        # Tasks can be queued and results taken from different threads
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.pools = {
+            'decode': Pool(self.settings['decode_workers']),
+            'ffmpeg': ThreadPool(self.settings['ffmpeg_slots']),
+            'io': ThreadPool(self.settings['io_threads']),
+        }
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for pool in self.pools.values():
+            if exc_type is None:
+                pool.close()
+            else:
+                pool.terminate()
+        for pool in self.pools.values():
+            pool.join()
+        self.pools = {}
+
+    def submit(self, task):
+        def on_error(e):
+            self.completed.put((task, "error", f"Error processing {task['file']}: {str(e)}"))
+
+        resource_class = RESOURCE_CLASSES[task['kind']]
+        task['submitted'] = time.time()
+        if 'queued' in task:
+            # Time spent waiting for room in the memory budget
+            record_span(task, 'admission', task['queued'], task['submitted'])
+        args = (task, self.settings)
+        if self.progress is not None and resource_class != 'decode':
+            args += (lambda fraction: self.progress.set_fraction(task, fraction),)
+
+        pool = self.pools[resource_class]
+        # Segmented videos take idle ffmpeg slots for their segments rather than extra threads
+        kwds = {'segment_pool': pool} if resource_class == 'ffmpeg' else {}
+        pool.apply_async(convert_file, args, kwds, callback=self.completed.put, error_callback=on_error)
+
+    def admit(self):
+        """Submit pending tasks in order while they fit in the memory budget, then the largest
+        of the others that still fit"""
+        def admit_from(entries):
+            while entries:
+                if not entries[0]:
+                    entries.popleft()
+                    continue
+                footprint = entries[0][0].get('footprint', 0)
+                # Always keep something running, even a file bigger than the whole budget
+                if self.memory_in_flight and self.memory_in_flight + footprint > self.memory_budget:
+                    return
+                task = entries.popleft().pop()
+                self.memory_in_flight += footprint
+                self.submit(task)
+
+        with self.lock:
+            admit_from(self.queue)
+            for bucket_index in sorted(self.buckets, reverse=True):
+                bucket = self.buckets[bucket_index]
+                admit_from(bucket)
+                if not bucket:
+                    del self.buckets[bucket_index]
+
+    def enqueue(self, tasks):
+        """Add tasks to the ones waiting for room in the memory budget"""
+        queued = time.time()
+        with self.lock:
+            for task in tasks:
+                task['queued'] = queued
+                entry = [task]
+                self.queue.append(entry)
+                bucket_index = int(task.get('footprint', 0)).bit_length()
+                self.buckets.setdefault(bucket_index, deque()).append(entry)
+
+    def finished(self, timeout=None):
+        """Wait for the next (task, status, message) to come back and free its memory.
+        Raises queue.Empty after timeout seconds."""
+        task, status, message = self.completed.get(timeout=timeout)
+        with self.lock:
+            self.memory_in_flight -= task.get('footprint', 0)
+        return task, status, message
+
+    def run(self, tasks):
+        """Submit tasks as memory allows and yield (task, status, message) as each completes"""
+        waiting = {}  # cache key -> tasks held back until the one converting it finishes
+        self.enqueue(hold_duplicates(tasks, waiting))
+
+        for _ in range(len(tasks)):
+            self.admit()
+            task, status, message = self.finished()
+            self.enqueue(release_duplicates(task, status, waiting))
+            yield task, status, message
+
+
+def convert_directory(input_dir, output_dir, progress_dict, dir_index, settings=None, profiles=None):
+    """Enhanced function for directory conversion with file management.
+
+    profiles is a list of output profiles (see 'output_profiles' in DEFAULT_SETTINGS) that
+    overrides the one in settings.
+    """
+    results = []
 
-    total_files = len(heic_files) + len(mov_files) + len(other_files)
-    if total_files == 0:
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    if profiles is not None:
+        settings['output_profiles'] = profiles
+    tasks = build_file_tasks([(input_dir, output_dir)], settings)
+    if not tasks:
         return results
 
     files_processed = 0
-
-    # Convert HEIC/HEIF files
-    for file in heic_files:
-        try:
-            img = HEIC2PNG(os.path.join(input_dir, file), quality=100)
-            output_file = os.path.join(output_dir, f"{file[:-5]}.png")
-            img.save(output_file)
+    trace = RunTrace()
+    cache_stats = CacheStats()
+    os.makedirs(output_dir, exist_ok=True)
+    with ConversionManifest(output_dir, settings) as manifest:
+        for task in tasks:
+            task, status, message = convert_file(task, settings)
+            manifest.record(task, status, message)
+            trace.add(task)
+            cache_stats.add(task)
             files_processed += 1
             progress_dict[dir_index] = files_processed
-            results.append(("success", f"Converted image: {file}"))
-        except Exception as e:
-            files_processed += 1
-            progress_dict[dir_index] = files_processed
-            results.append(("error", f"Error converting {file}: {str(e)}"))
+            results.append((status, message))
 
-    # Convert MOV files
-    for file in mov_files:
-        try:
-            input_path = os.path.join(input_dir, file)
-
-            # Ensure output path has .mp4 extension and handle spaces in path
-            base_name = os.path.splitext(file)[0]
-            output_path = os.path.join(output_dir, f"{base_name}.mp4")
-
-            # Fixed ffmpeg command with proper quotation and parameters
-            ffmpeg_command = (
-                f'ffmpeg -y -i "{input_path}" -vf '
-                'zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,'
-                'tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,'
-                f'format=yuv420p -x264-params colormatrix=bt709 -crf 21 -c:a copy "{output_path}" '
-                '-hide_banner -loglevel error -stats'
-            )
-
-            os.system(ffmpeg_command)
-            files_processed += 1
-            progress_dict[dir_index] = files_processed
-            results.append(("success", f"Converted video: {file}"))
-        except Exception as e:
-            files_processed += 1
-            progress_dict[dir_index] = files_processed
-            results.append(("error", f"Error converting {file}: {str(e)}"))
+    trace.print_summary()
+    cache_stats.print_summary()
+    if settings['trace_dir']:
+        trace.export(settings['trace_dir'])
+    return results
 
-    # Copy other files
-    for file in other_files:
-        try:
-            input_path = os.path.join(input_dir, file)
-            output_path = os.path.join(output_dir, file)
-            import shutil
-            shutil.copy2(input_path, output_path)  # copy2 preserves metadata
-            files_processed += 1
-            progress_dict[dir_index] = files_processed
-            results.append(("success", f"Copied file: {file}"))
-        except Exception as e:
-            files_processed += 1
-            progress_dict[dir_index] = files_processed
-            results.append(("error", f"Error copying {file}: {str(e)}"))
 
+class ProgressCounters:
+    """Per-directory file counters in shared memory, plus cost-weighted progress.
+
+    Workers' results already stream back to the parent over the pool's result pipe, so the
+    parent simply bumps a counter per result and readers such as the GUI take a snapshot
+    whenever they redraw. There is no manager process and no proxy round trip per file.
+
+    Each task also carries an estimated cost, so a long 4K video weighs far more than a
+    small photo. Transcodes report the fraction they have done while running, which keeps
+    the weighted total, the throughput and the ETA moving between completions.
+    """
+
+    def __init__(self, num_dirs, total_files=0, total_cost=0.0):
+        self.counts = multiprocessing.RawArray('q', num_dirs)
+        self.total_files = total_files
+        self.total_cost = total_cost
+        self.done_cost = 0.0
+        self.partial_cost = {}  # task_id -> cost done so far of tasks still running
+        self.lock = threading.Lock()
+        # Restarted by run_conversion once planning is done
+        self.start_time = time.monotonic()
+
+    def __getitem__(self, dir_index):
+        return self.counts[dir_index]
+
+    def __setitem__(self, dir_index, value):
+        self.counts[dir_index] = value
+
+    def add(self, dir_index, count=1, task=None):
+        self.counts[dir_index] += count
+        if task is not None:
+            with self.lock:
+                self.partial_cost.pop(task['task_id'], None)
+                self.done_cost += task['cost']
+
+    def set_fraction(self, task, fraction):
+        """Record how far along a running task is, from 0 to 1"""
+        with self.lock:
+            self.partial_cost[task['task_id']] = task['cost'] * min(max(fraction, 0.0), 1.0)
+
+    def snapshot(self):
+        """(files processed, total files) across all directories"""
+        return sum(self.counts), self.total_files
+
+    def weighted_snapshot(self):
+        """Cost-weighted fraction done, files per second and estimated seconds remaining"""
+        with self.lock:
+            done = self.done_cost + sum(self.partial_cost.values())
+        elapsed = time.monotonic() - self.start_time
+        files_per_second = sum(self.counts) / elapsed if elapsed > 0 else 0.0
+
+        if self.total_cost <= 0:
+            return 0.0, files_per_second, None
+        fraction = min(done / self.total_cost, 1.0)
+        eta = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+        return fraction, files_per_second, eta
+
+
+def format_duration(seconds):
+    """Short human readable duration such as 1h02m or 3m05s"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class RunTrace:
+    """Collects the spans of finished tasks for export and a per-stage summary"""
+
+    def __init__(self):
+        self.spans = []
+
+    def add(self, task):
+        self.spans.extend(task.get('spans', []))
+
+    def summary(self):
+        """stage -> {'count', 'total', 'mean', 'max'} in seconds, plus 'cpu' where known"""
+        stages = {}
+        for item in self.spans:
+            stats = stages.setdefault(item['stage'], {'count': 0, 'total': 0.0, 'max': 0.0, 'cpu': 0.0})
+            duration = item['end'] - item['start']
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            stats['cpu'] += item.get('cpu') or 0.0
+        for stats in stages.values():
+            stats['mean'] = stats['total'] / stats['count']
+        return stages
+
+    def print_summary(self):
+        print("\n=== Stage Timing Summary ===")
+        for stage, stats in sorted(self.summary().items(), key=lambda item: -item[1]['total']):
+            line = (f"- {stage}: {stats['count']} spans, total {stats['total']:.2f}s, "
+                    f"mean {stats['mean']:.3f}s, max {stats['max']:.2f}s")
+            if stats['cpu']:
+                line += f", CPU {stats['cpu']:.2f}s"
+            print(line)
+        print("=== End Stage Timing Summary ===\n")
+
+    def write_jsonl(self, path):
+        with open(path, 'w') as f:
+            for item in self.spans:
+                f.write(json.dumps({**item, 'duration': item['end'] - item['start']}) + "\n")
+
+    def write_chrome_trace(self, path):
+        """Chrome trace event format, which Perfetto and chrome://tracing both open"""
+        events = [{
+            'name': f"{item['stage']} {item['file']}",
+            'cat': item['stage'],
+            'ph': 'X',
+            'ts': item['start'] * 1e6,
+            'dur': (item['end'] - item['start']) * 1e6,
+            'pid': item['pid'],
+            'tid': item['tid'],
+            'args': {key: value for key, value in item.items() if key not in ('start', 'end', 'pid', 'tid')},
+        } for item in self.spans]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def export(self, trace_dir):
+        os.makedirs(trace_dir, exist_ok=True)
+        self.write_jsonl(os.path.join(trace_dir, 'spans.jsonl'))
+        self.write_chrome_trace(os.path.join(trace_dir, 'trace.json'))
+
+
+def run_conversion(directory_data, settings=None, scans=None, progress=None, executor=None, on_result=None):
+    """Convert every directory pair, returning a list of (status, message) lists per pair.
+
+    Every file of every directory runs on the pool for its resource class. Each result is
+    recorded in the output directory's manifest and counted in progress as it arrives, and
+    on_result(task, status, message) is called with it when given.
+    Pass an open ResourceExecutor to reuse its pools instead of starting new ones.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    tasks = build_file_tasks(directory_data, settings, scans)
+    results = [[] for _ in directory_data]
+    trace = RunTrace()
+    cache_stats = CacheStats()
+    if progress is None:
+        progress = ProgressCounters(len(directory_data))
+    # Costs are only known once the tasks are built, and the time spent planning them (header
+    # reads, probes, hashing) does not count towards the throughput and ETA
+    progress.total_files = len(tasks)
+    progress.total_cost = sum(task['cost'] for task in tasks)
+    progress.start_time = time.monotonic()
+    # Pairs from a mirrored tree or an imported list usually name output folders not made yet
+    for _, output_dir in directory_data:
+        os.makedirs(output_dir, exist_ok=True)
+    manifests = [ConversionManifest(output_dir, settings) for _, output_dir in directory_data]
+
+    if executor is None:
+        executor_context = ResourceExecutor(settings, progress)
+    else:
+        executor.progress = progress
+        executor_context = nullcontext(executor)
+
+    try:
+        with executor_context as executor:
+            for task, status, message in executor.run(tasks):
+                dir_index = task['dir_index']
+                manifests[dir_index].record(task, status, message)
+                results[dir_index].append((status, message))
+                progress.add(dir_index, task=task)
+                if on_result is not None:
+                    on_result(task, status, message)
+                # Time from the worker finishing to the result reaching us
+                record_span(task, 'result', task.get('finished', time.time()))
+                trace.add(task)
+                cache_stats.add(task)
+    finally:
+        for manifest in manifests:
+            manifest.close()
+
+    trace.print_summary()
+    cache_stats.print_summary()
+    if settings['trace_dir']:
+        trace.export(settings['trace_dir'])
     return results
 
 
-def cleanup_output_directory(output_dir):
-    """Clean up output directory by removing AAE files and handling duplicates"""
-    results = []
+# Bytes hashed from each end of a file before paying for a full hash
+DEDUPE_EDGE_BYTES = 64 * 1024
 
-    # Initialize counters
-    aae_count = 0
-    duplicate_count = 0
 
-    print("\n=== Cleanup Summary ===")
-    print(f"Cleaning directory: {output_dir}")
+def edge_digest(path, size):
+    """SHA-256 of the first and last DEDUPE_EDGE_BYTES of a file (all of it if smaller)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if size <= 2 * DEDUPE_EDGE_BYTES:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(DEDUPE_EDGE_BYTES))
+            f.seek(-DEDUPE_EDGE_BYTES, os.SEEK_END)
+            digest.update(f.read(DEDUPE_EDGE_BYTES))
+    return digest.hexdigest()
+
+
+def group_by(records, key_function, threads):
+    """Split records into groups of equal key, keeping only groups with more than one member"""
+    with ThreadPool(threads) as pool:
+        keys = pool.map(key_function, records)
+    groups = {}
+    for record, key in zip(records, keys):
+        groups.setdefault(key, []).append(record)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(records, threads=4, source_of=None):
+    """Find files with identical content, returning (duplicate, original) record pairs.
+
+    Files are bucketed by size first, then by a hash of their first and last few KB, and
+    only the files still colliding after that are hashed in full. Most files are never read
+    at all and most of the rest only at the edges. Within each group of identical files the
+    first record in the given order is kept as the original. Empty files are ignored.
+
+    source_of maps absolute output paths to the source they were converted from. Outputs of
+    the same source, like a photo smaller than a derivative's size, are all kept.
+    """
+    by_size = {}
+    for record in records:
+        if record['size'] > 0:
+            by_size.setdefault(record['size'], []).append(record)
+
+    candidates = [group for group in by_size.values() if len(group) > 1]
+    identical = []
+    for group in candidates:
+        size = group[0]['size']
+        for edge_group in group_by(group, lambda record: edge_digest(record['input_path'], size), threads):
+            if size <= 2 * DEDUPE_EDGE_BYTES:
+                # The edges already covered the whole file
+                identical.append(edge_group)
+            else:
+                identical.extend(group_by(edge_group, lambda record: file_digest(record['input_path']), threads))
+
+    source_of = source_of or {}
+
+    def source(record):
+        path = os.path.abspath(record['input_path'])
+        return source_of.get(path, path)
+
+    duplicates = []
+    for group in identical:
+        original = group[0]
+        duplicates.extend((duplicate, original) for duplicate in group[1:] if source(duplicate) != source(original))
+    return duplicates
+
+
+def remove_aae_files(output_dir, records, dry_run=False):
+    """Remove AAE sidecars among the records, returning (results, count)"""
+    results = []
+    count = 0
 
-    # Remove AAE files
     print("\nRemoving AAE files:")
-    aae_files = [f for f in os.listdir(output_dir) if f.endswith('.AAE')]
+    aae_files = [record['file'] for record in records if record['kind'] == 'sidecar']
     if not aae_files:
         print("No AAE files found")
     else:
         print(f"Found {len(aae_files)} AAE files:")
         for file in aae_files:
+            if dry_run:
+                print(f"- Would remove: {file}")
+                results.append(("cleanup", f"Would remove AAE file: {file}"))
+                count += 1
+                continue
             try:
                 os.remove(os.path.join(output_dir, file))
                 print(f"- Removed: {file}")
                 results.append(("cleanup", f"Removed AAE file: {file}"))
-                aae_count += 1
+                count += 1
             except Exception as e:
                 print(f"- Error removing {file}: {str(e)}")
                 results.append(("error", f"Error removing AAE file {file}: {str(e)}"))
 
-    # Handle duplicates
-    print("\nChecking for duplicates:")
-    files = os.listdir(output_dir)
-    seen_files = {}  # Changed to store full filename as key
-    duplicates = []
+    return results, count
 
-    for file in files:
-        # Skip AAE files as they're already handled
-        if file.endswith('.AAE'):
-            continue
 
-        if file in seen_files:
-            duplicates.append((file, seen_files[file]))  # Store both duplicate and original
-        else:
-            seen_files[file] = file
+def remove_duplicates(records, dry_run=False, threads=4):
+    """Remove files whose content duplicates an earlier record, returning (results, count).
+
+    Outputs removed this way are marked in their directory's manifest so the next run does
+    not convert them again.
+    """
+    results = []
+    count = 0
+
+    print("\nChecking for duplicates:")
+    source_of = {}
+    for output_dir in {record['output_dir'] for record in records}:
+        if os.path.exists(os.path.join(output_dir, MANIFEST_NAME)):
+            with ConversionManifest(output_dir) as manifest:
+                source_of.update(manifest.output_sources())
+    # Skip AAE files as they're handled separately
+    duplicates = find_duplicates([record for record in records if record['kind'] != 'sidecar'], threads, source_of)
 
     if not duplicates:
         print("No duplicate files found")
-    else:
-        print(f"Found {len(duplicates)} duplicate files:")
-        for duplicate, original in duplicates:
-            try:
-                os.remove(os.path.join(output_dir, duplicate))
-                print(f"- Removed: {duplicate} (duplicate of {original})")
-                results.append(("cleanup", f"Removed duplicate file: {duplicate} (duplicate of {original})"))
-                duplicate_count += 1
-            except Exception as e:
-                print(f"- Error removing {duplicate}: {str(e)}")
-                results.append(("error", f"Error removing duplicate file {duplicate}: {str(e)}"))
+        return results, count
+
+    print(f"Found {len(duplicates)} duplicate files:")
+    for duplicate, original in duplicates:
+        duplicate_path, original_path = duplicate['input_path'], original['input_path']
+        if dry_run:
+            print(f"- Would remove: {duplicate_path} (duplicate of {original_path})")
+            results.append(("cleanup", f"Would remove duplicate file: {duplicate_path} (duplicate of {original_path})"))
+            count += 1
+            continue
+        try:
+            os.remove(duplicate_path)
+            manifest_dir = duplicate['output_dir']
+            if os.path.exists(os.path.join(manifest_dir, MANIFEST_NAME)):
+                with ConversionManifest(manifest_dir) as manifest:
+                    manifest.mark_duplicate(duplicate_path, original_path)
+            print(f"- Removed: {duplicate_path} (duplicate of {original_path})")
+            results.append(("cleanup", f"Removed duplicate file: {duplicate_path} (duplicate of {original_path})"))
+            count += 1
+        except Exception as e:
+            print(f"- Error removing {duplicate_path}: {str(e)}")
+            results.append(("error", f"Error removing duplicate file {duplicate_path}: {str(e)}"))
+
+    return results, count
+
+
+def scan_output_directory(output_dir):
+    """scan_directory records of an output tree, tagged with the directory they belong to"""
+    return [{**record, 'output_dir': output_dir} for record in scan_directory(output_dir)]
+
+
+def cleanup_output_directory(output_dir, dry_run=False):
+    """Clean up output directory by removing AAE files and duplicate files.
+
+    Returns (results, AAE files removed, duplicates removed). With dry_run nothing is
+    deleted and the results describe what would have been removed.
+    """
+    print("\n=== Cleanup Summary ===")
+    print(f"Cleaning directory: {output_dir}" + (" (dry run)" if dry_run else ""))
+
+    # List the output tree once for both passes
+    records = scan_output_directory(output_dir)
+
+    aae_results, aae_count = remove_aae_files(output_dir, records, dry_run)
+    duplicate_results, duplicate_count = remove_duplicates(records, dry_run)
 
     # Print final summary
     print("\nCleanup Summary:")
@@ -160,16 +1820,38 @@ def cleanup_output_directory(output_dir):
     print(f"- Total files removed: {aae_count + duplicate_count}")
     print("=== End Cleanup Summary ===\n")
 
-    return results
+    return aae_results + duplicate_results, aae_count, duplicate_count
+
 
+def cleanup_all_directories(directory_data, dry_run=False, across_directories=False):
+    """Clean up all output directories and provide a total summary.
 
-def cleanup_all_directories(directory_data):
-    """Clean up all output directories and provide a total summary"""
+    With across_directories, duplicates are looked for across all output directories at
+    once, keeping the copy in the earliest directory pair. Returns (results, AAE files
+    removed, duplicates removed).
+    """
+    results = []
     total_aae_removed = 0
     total_duplicates_removed = 0
 
-    for _, output_dir in directory_data:
-        cleanup_output_directory(output_dir)
+    if across_directories:
+        all_records = []
+        for _, output_dir in directory_data:
+            print(f"\nCleaning directory: {output_dir}" + (" (dry run)" if dry_run else ""))
+            records = scan_output_directory(output_dir)
+            aae_results, aae_count = remove_aae_files(output_dir, records, dry_run)
+            results += aae_results
+            total_aae_removed += aae_count
+            all_records += records
+
+        duplicate_results, total_duplicates_removed = remove_duplicates(all_records, dry_run)
+        results += duplicate_results
+    else:
+        for _, output_dir in directory_data:
+            dir_results, aae_count, duplicate_count = cleanup_output_directory(output_dir, dry_run)
+            results += dir_results
+            total_aae_removed += aae_count
+            total_duplicates_removed += duplicate_count
 
     print("\n=== Final Cleanup Statistics ===")
     print(f"Total AAE files removed: {total_aae_removed}")
@@ -177,367 +1859,469 @@ def cleanup_all_directories(directory_data):
     print(f"Total files removed: {total_aae_removed + total_duplicates_removed}")
     print("=== End Final Statistics ===\n")
 
-
-def browse_directory(entry):
-    directory = filedialog.askdirectory()
-    if directory:
-        entry.delete(0, tk.END)
-        entry.insert(0, directory)
-
-
-class MediaConverterGUI:
-    def __init__(self):
-        self.window = tk.Tk()
-        self.window.title("Multi-Folder Media Converter")
-        self.window.geometry("800x600")
-
-        # List of input/output directory pairs
-        self.directory_pairs = []
-
-        # Create main container
-        self.main_container = ttk.Frame(self.window)
-        self.main_container.pack(fill='both', expand=True, padx=10, pady=10)
-
-        # Directory list frame
-        self.dir_list_frame = ttk.LabelFrame(self.main_container, text="Directory Pairs")
-        self.dir_list_frame.pack(fill='both', expand=True, padx=5, pady=5)
-
-        # Total progress frame
-        self.total_progress_frame = ttk.Frame(self.main_container)
-        self.total_progress_frame.pack(fill='x', padx=5, pady=5)
-
-        self.total_progress_label = ttk.Label(self.total_progress_frame, text="Total Progress: ")
-        self.total_progress_label.pack(side='left')
-
-        self.total_progress = ttk.Progressbar(self.total_progress_frame, mode='determinate')
-        self.total_progress.pack(side='left', fill='x', expand=True, padx=5)
-
-        self.progress_text = ttk.Label(self.total_progress_frame, text="0/0 files")
-        self.progress_text.pack(side='left')
-
-        # Scrollable frame for directory pairs
-        self.canvas = tk.Canvas(self.dir_list_frame)
-        self.scrollbar = ttk.Scrollbar(self.dir_list_frame, orient="vertical", command=self.canvas.yview)
-        self.scrollable_frame = ttk.Frame(self.canvas)
-
-        self.scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all"))
-        )
-
-        self.canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-
-        self.canvas.pack(side="left", fill="both", expand=True)
-        self.scrollbar.pack(side="right", fill="y")
-
-        # Buttons frame
-        self.button_frame = ttk.Frame(self.main_container)
-        self.button_frame.pack(fill='x', pady=10)
-
-        self.add_pair_button = ttk.Button(self.button_frame, text="Add Directory Pair", command=self.add_directory_pair)
-        self.add_pair_button.pack(side='left', padx=5)
-
-        self.remove_pair_button = ttk.Button(self.button_frame, text="Remove Selected",
-                                             command=self.remove_selected_pair)
-        self.remove_pair_button.pack(side='left', padx=5)
-
-        self.convert_button = ttk.Button(self.button_frame, text="Convert All", command=self.start_conversion)
-        self.convert_button.pack(side='right', padx=5)
-
-        # Status text
-        self.status_frame = ttk.LabelFrame(self.main_container, text="Status")
-        self.status_frame.pack(fill='both', expand=True, padx=5, pady=5)
-
-        self.status_text = tk.Text(self.status_frame, height=10, width=50)
-        self.status_text.pack(fill='both', expand=True)
-
-        # Message queue for status updates
-        self.status_queue = Queue()
-        self.progress_queue = Queue()
-        self.window.after(100, self.check_queues)
-
-        # Store all directory buttons
-        self.directory_buttons = []
-
-    def remove_selected_pair(self):
-        to_remove = []
-        buttons_to_remove = []  # New list to track buttons to remove
-
-        for pair in self.directory_pairs:
-            if pair['check'].get():
-                # Find the input and output buttons associated with this pair
-                frame = pair['frame']
-                frame_buttons = [btn for btn in self.directory_buttons
-                                 if str(btn.master) == str(frame)]
-                buttons_to_remove.extend(frame_buttons)
-
-                # Destroy the frame
-                pair['frame'].destroy()
-                to_remove.append(pair)
-
-        # Remove the pairs
-        for pair in to_remove:
-            self.directory_pairs.remove(pair)
-
-        # Remove the buttons from directory_buttons list
-        for btn in buttons_to_remove:
-            if btn in self.directory_buttons:
-                self.directory_buttons.remove(btn)
-
-    def add_directory_pair(self):
-        pair_frame = ttk.Frame(self.scrollable_frame)
-        pair_frame.pack(fill='x', padx=5, pady=5)
-
-        # Checkbox for selection
-        var = tk.BooleanVar()
-        check = ttk.Checkbutton(pair_frame, variable=var)
-        check.pack(side='left')
-
-        # Input directory
-        input_entry = ttk.Entry(pair_frame)
-        input_entry.pack(side='left', fill='x', expand=True, padx=5)
-
-        input_button = ttk.Button(
-            pair_frame,
-            text="Input",
-            command=lambda: browse_directory(input_entry)
-        )
-        input_button.pack(side='left')
-        self.directory_buttons.append(input_button)
-
-        # Output directory
-        output_entry = ttk.Entry(pair_frame)
-        output_entry.pack(side='left', fill='x', expand=True, padx=5)
-
-        output_button = ttk.Button(
-            pair_frame,
-            text="Output",
-            command=lambda: browse_directory(output_entry)
-        )
-        output_button.pack(side='left')
-        self.directory_buttons.append(output_button)
-
-        # Progress bar
-        progress_bar = ttk.Progressbar(pair_frame, mode='determinate')
-        progress_bar.pack(side='left', padx=5, fill='x', expand=True)
-
-        self.directory_pairs.append({
-            'frame': pair_frame,
-            'check': var,
-            'input': input_entry,
-            'output': output_entry,
-            'progress': progress_bar,
-            'input_button': input_button,  # Store references to buttons
-            'output_button': output_button  # Store references to buttons
-        })
-
-    def update_status(self, message):
-        self.status_queue.put(message)
-
-    def process_directories(self, directory_data, total_files):
-        with Manager() as manager:
-            # Create a shared dictionary to track progress
-            progress_dict = manager.dict()
-
-            # Initialize progress for each directory
-            for i in range(len(directory_data)):
-                progress_dict[i] = 0
-
-            # Create a progress update function
-            def update_progress():
-                while True:
-                    try:
-                        current_total = sum(progress_dict.values())
-                        self.progress_queue.put((current_total, total_files))
-                        time.sleep(0.1)  # Update every 100ms
-
-                    except:
-                        break
-
-            # Start progress update thread
-            progress_thread = threading.Thread(target=update_progress, daemon=True)
-            progress_thread.start()
-
-            # Create pool and process directories
+    return results, total_aae_removed, total_duplicates_removed
+
+
+# inotify(7) constants from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# How often the watch loop wakes up while files are settling, and while it is idle
+WATCH_TICK = 0.5
+WATCH_IDLE_TICK = 1.0
+# Rescan interval where inotify is not available
+WATCH_POLL_SECONDS = 5.0
+
+
+def stat_record(root, rel_path):
+    """The scan_tree record of a single file"""
+    path = os.path.join(root, rel_path)
+    stat = os.stat(path)
+    return {
+        'file': rel_path,
+        'kind': classify_file(os.path.basename(rel_path)),
+        'input_path': path,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+class InotifyWatcher:
+    """Files created or changed under a set of directory trees, from Linux inotify via ctypes"""
+
+    def __init__(self, roots):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.roots = roots
+        self.watches = {}  # watch descriptor -> directory
+        for root in roots:
+            self.add_tree(root)
+
+    def add_tree(self, directory):
+        """Watch directory and every directory below it, returning the files already in them"""
+        files = []
+        pending_dirs = [directory]
+        while pending_dirs:
+            path = pending_dirs.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT:
+                    continue  # Removed again before we got to it
+                raise OSError(error, os.strerror(error), path)
+            self.watches[wd] = path
             try:
-                with Pool() as pool:
-                    # Create tasks with progress tracking
-                    tasks = [(input_dir, output_dir, progress_dict, i)
-                             for i, (input_dir, output_dir) in enumerate(directory_data)]
-
-                    # Start processing
-                    results = []
-                    for result in pool.starmap(convert_directory, tasks):
-                        results.append(result)
-
-                    return results
-            finally:
-                # Ensure final progress is updated
-                current_total = sum(progress_dict.values())
-                self.progress_queue.put((current_total, total_files))
-
-    def check_queues(self):
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending_dirs.append(entry.path)
+                        elif entry.is_file():
+                            files.append(entry.path)
+            except FileNotFoundError:
+                continue
+        return files
+
+    def changes(self, timeout):
+        """Paths of files touched since the last call, waiting up to timeout seconds for one"""
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: every file is a candidate again and the manifests
+                    # skip the ones that are done
+                    changed.update(record['input_path'] for root in self.roots for record in scan_tree(root))
+                elif mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                elif wd in self.watches:
+                    path = os.path.join(self.watches[wd], name)
+                    if not mask & IN_ISDIR:
+                        changed.add(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        # Files can land in a new directory before its watch is in place
+                        changed.update(self.add_tree(path))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Stand-in for InotifyWatcher where inotify is not available, rescanning the trees
+    every WATCH_POLL_SECONDS and reporting files whose size or mtime changed"""
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.seen = self.snapshot()
+        self.next_scan = time.monotonic() + WATCH_POLL_SECONDS
+
+    def snapshot(self):
+        return {record['input_path']: (record['size'], record['mtime_ns'])
+                for root in self.roots for record in scan_tree(root)}
+
+    def changes(self, timeout):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0, wait))
+        self.next_scan = time.monotonic() + WATCH_POLL_SECONDS
+
+        current = self.snapshot()
+        changed = {path for path, stat in current.items() if self.seen.get(path) != stat}
+        self.seen = current
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(roots):
+    """An InotifyWatcher on the trees under roots, or a PollingWatcher where that fails"""
+    try:
+        return InotifyWatcher(roots)
+    except (AttributeError, TypeError, OSError) as e:
+        print(f"inotify unavailable ({e}), polling every {WATCH_POLL_SECONDS:.0f}s instead")
+        return PollingWatcher(roots)
+
+
+def settled_files(pending, settle_seconds):
+    """Take the files out of pending whose size and mtime held still for settle_seconds.
+
+    pending maps each path to its (size, mtime_ns, when it last changed); a file being
+    copied in keeps changing and stays pending until the copy is done.
+    """
+    now = time.monotonic()
+    ready = []
+    for path, (size, mtime_ns, since) in list(pending.items()):
         try:
-            # Check status queue
-            while not self.status_queue.empty():
-                message = self.status_queue.get_nowait()
-                self.status_text.insert(tk.END, message + "\n")
-                self.status_text.see(tk.END)
-
-            # Check progress queue
-            while not self.progress_queue.empty():
+            stat = os.stat(path)
+        except FileNotFoundError:
+            del pending[path]
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+        elif now - since >= settle_seconds:
+            ready.append(path)
+            del pending[path]
+    return ready
+
+
+class OutputIndex:
+    """The files of an output directory grouped by size, so that new outputs are only
+    compared against the earlier outputs they could possibly duplicate"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.by_size = {}  # size -> {path: record}
+        self.sizes = {}  # path -> size
+        for record in scan_output_directory(output_dir):
+            self.add(record)
+
+    def add(self, record):
+        self.by_size.setdefault(record['size'], {})[record['input_path']] = record
+        self.sizes[record['input_path']] = record['size']
+
+    def discard(self, path):
+        size = self.sizes.pop(path, None)
+        if size is not None:
+            del self.by_size[size][path]
+
+    def cleanup(self, paths, dry_run=False):
+        """Remove AAE files and duplicates among the given new outputs.
+
+        Returns (results, AAE files removed, duplicates removed) like cleanup_output_directory.
+        """
+        new_records = []
+        for path in paths:
+            # A rewritten output may have changed size
+            self.discard(path)
+            try:
+                record = stat_record(self.output_dir, os.path.relpath(path, self.output_dir))
+            except FileNotFoundError:
+                continue
+            new_records.append({**record, 'output_dir': self.output_dir})
+
+        aae_results, aae_count = remove_aae_files(self.output_dir, new_records, dry_run)
+        new_records = [record for record in new_records if record['kind'] != 'sidecar']
+        # Earlier outputs come first so they are the ones kept
+        sizes = {record['size'] for record in new_records}
+        candidates = [record for size in sizes for record in self.by_size.get(size, {}).values()]
+        duplicate_results, duplicate_count = remove_duplicates(candidates + new_records, dry_run)
+
+        for record in new_records:
+            if os.path.exists(record['input_path']):
+                self.add(record)
+        return aae_results + duplicate_results, aae_count, duplicate_count
+
+
+def watched_scans(paths, directory_data, settings=None):
+    """Records for changed input files, grouped per directory pair like scan_directory's"""
+    input_dirs = [os.path.abspath(input_dir) for input_dir, _ in directory_data]
+    output_dirs = [os.path.abspath(path) for _, output_dir in directory_data
+                   for path in generated_dirs(output_dir, settings)]
+    scans = [[] for _ in directory_data]
+    for path in sorted(paths):
+        # An output directory inside an input directory must not feed back into it
+        if any(path.startswith(output_dir + os.sep) for output_dir in output_dirs):
+            continue
+        if os.path.basename(path).startswith(MANIFEST_NAME):
+            continue
+        for dir_index, input_dir in enumerate(input_dirs):
+            if path.startswith(input_dir + os.sep):
                 try:
-                    current, total = self.progress_queue.get_nowait()
-                    if total > 0:  # Prevent division by zero
-                        percentage = (current / total) * 100
-                        self.total_progress['value'] = percentage
-                        self.progress_text['text'] = f"{current}/{total} files ({percentage:.1f}%)"
-                        self.window.update_idletasks()
-
-                except Empty:
+                    scans[dir_index].append(stat_record(input_dir, os.path.relpath(path, input_dir)))
+                except FileNotFoundError:
                     pass
+                break
+    return scans
+
+
+def watch_directories(directory_data, settings=None, stop=None):
+    """Keep converting new and changed files under the input directories until stop is set.
+
+    Starts with a regular run over everything the manifests do not mark as done, then feeds
+    files to the pools as they show up, once their size and mtime have held still for
+    watch_settle seconds, so files still being copied in are not picked up half written.
+    Only the new outputs are checked for AAE files and duplicates.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    stop = stop or threading.Event()
+    directory_data = [(os.path.abspath(input_dir), os.path.abspath(output_dir))
+                      for input_dir, output_dir in directory_data]
+    for _, output_dir in directory_data:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Watch before the first scan so nothing written in between is missed
+    watcher = open_watcher([input_dir for input_dir, _ in directory_data])
+    pending = {}
+    try:
+        # The pools stay up between batches instead of starting again for every few files
+        with ResourceExecutor(settings) as executor:
+            run_conversion(directory_data, settings, executor=executor)
+            cleanup_all_directories(directory_data)
+            indexes = [OutputIndex(output_dir) for _, output_dir in directory_data]
+            print(f"Watching {len(directory_data)} input directories for new files...")
+
+            while not stop.is_set():
+                now = time.monotonic()
+                for path in watcher.changes(WATCH_TICK if pending else WATCH_IDLE_TICK):
+                    pending[path] = (None, None, now)
+                ready = settled_files(pending, settings['watch_settle'])
+                if not ready:
+                    continue
+
+                scans = watched_scans(ready, directory_data, settings)
+                results = run_conversion(directory_data, settings, scans, executor=executor)
+                for dir_index, (_, output_dir) in enumerate(directory_data):
+                    for status, message in results[dir_index]:
+                        print(f"{status}: {message}")
+                    outputs = [path for record in scans[dir_index] if record['kind'] != 'sidecar'
+                               for path in output_paths_for(record['kind'], record['file'], output_dir, settings)]
+                    if outputs:
+                        indexes[dir_index].cleanup(outputs)
+    finally:
+        watcher.close()
+
+
+def load_directory_pairs(path):
+    """(input_dir, output_dir) pairs from a CSV file of input,output rows (a header row is
+    optional) or a JSON list of [input, output] lists or {"input": ..., "output": ...}
+    objects. Relative paths are taken relative to the file's own directory."""
+    if path.lower().endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            items = json.load(f)
+        pairs = [(item['input'], item['output']) if isinstance(item, dict) else tuple(item) for item in items]
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = [row for row in csv.reader(f) if any(cell.strip() for cell in row)]
+        if rows and [cell.strip().lower() for cell in rows[0][:2]] == ['input', 'output']:
+            rows = rows[1:]
+        pairs = [tuple(cell.strip() for cell in row) for row in rows]
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for pair in pairs:
+        if len(pair) != 2 or not all(pair):
+            raise ValueError(f"Not an input/output directory pair: {pair}")
+    return [(os.path.join(base_dir, input_dir), os.path.join(base_dir, output_dir)) for input_dir, output_dir in pairs]
+
+
+def mirror_directory_pairs(input_root, output_root):
+    """A pair per subfolder of input_root into the same-named subfolder of output_root, as for
+    a folder holding one export per camera roll. Files directly in input_root are left out,
+    since a pair for the root itself would take in every subfolder a second time."""
+    output_root_path = os.path.abspath(output_root)
+    with os.scandir(input_root) as entries:
+        names = sorted(entry.name for entry in entries if entry.is_dir()
+                       and os.path.abspath(entry.path) != output_root_path)
+    return [(os.path.join(input_root, name), os.path.join(output_root, name)) for name in names]
+
+
+def convert(pairs, options=None, cleanup=True, dry_run=False, stream=None, executor=None):
+    """Convert (input_dir, output_dir) pairs without the GUI, then clean up their outputs.
+
+    options overrides DEFAULT_SETTINGS. Progress is written to stream (stdout by default) as
+    JSON lines: a 'start' event, a 'file' event as each file finishes, a 'cleanup' event per
+    output directory and a final 'done' event. The human-readable summaries go to stderr
+    meanwhile so the stream stays machine-readable. Returns the (status, message) results
+    of each pair, cleanup included.
+    executor is passed on to run_conversion, e.g. a distributed.Coordinator to have remote
+    workers do the converting.
+    """
+    settings = {**DEFAULT_SETTINGS, **(options or {})}
+    stream = stream or sys.stdout
+    pairs = [(input_dir, output_dir) for input_dir, output_dir in pairs]
+    start_time = time.monotonic()
+
+    def emit(event, **fields):
+        stream.write(json.dumps({'event': event, **fields}) + "\n")
+        stream.flush()
+
+    with redirect_stdout(sys.stderr):
+        for _, output_dir in pairs:
+            os.makedirs(output_dir, exist_ok=True)
+        scans = [scan_directory(input_dir, generated_dirs(output_dir, settings)) for input_dir, output_dir in pairs]
+        emit('start', pairs=len(pairs), scanned=sum(len(records) for records in scans))
+
+        progress = ProgressCounters(len(pairs))
+
+        def on_result(task, status, message):
+            done, total = progress.snapshot()
+            fraction, files_per_second, eta = progress.weighted_snapshot()
+            emit('file', pair=task['dir_index'], file=task['file'], kind=task['kind'], status=status,
+                 message=message, done=done, total=total, fraction=round(fraction, 4),
+                 files_per_second=round(files_per_second, 2), eta=None if eta is None else round(eta, 1))
+
+        results = run_conversion(pairs, settings, scans, progress, executor, on_result)
+
+        if cleanup:
+            for dir_index, (_, output_dir) in enumerate(pairs):
+                cleanup_results, aae_removed, duplicates_removed = cleanup_output_directory(output_dir, dry_run)
+                results[dir_index] += cleanup_results
+                emit('cleanup', pair=dir_index, output_dir=output_dir, dry_run=dry_run,
+                     aae_removed=aae_removed, duplicates_removed=duplicates_removed)
+
+    statuses = [status for pair_results in results for status, _ in pair_results]
+    emit('done', files=progress.snapshot()[0], errors=statuses.count('error'),
+         seconds=round(time.monotonic() - start_time, 3))
+    return results
 
-        except Exception as e:
-            print(f"Error in check_queues: {str(e)}")
-
-        finally:
-            self.window.after(50, self.check_queues)  # Check more frequently (50ms)
-
-    def start_conversion(self):
-        # Collect directory pairs and count files
-        directory_data = []
-        total_images = 0
-        total_videos = 0
-        total_other = 0
-        conversion_summary = []
-
-        print("\n=== Conversion Summary ===")
-        print("Processing the following directories:\n")
-
-        for pair in self.directory_pairs:
-            input_dir = pair['input'].get()
-            output_dir = pair['output'].get()
-
-            if input_dir and output_dir:
-                # Count files in this directory
-                num_images, num_videos, num_other, image_files, video_files, other_files = get_file_counts(input_dir)
-                total_images += num_images
-                total_videos += num_videos
-                total_other += num_other
-
-                # Print directory information
-                print(f"\nInput Directory:  {input_dir}")
-                print(f"Output Directory: {output_dir}")
-                print(f"Files to process:")
-                print(
-                    f"- Images: {num_images} ({', '.join(image_files) if num_images < 6 else ', '.join(image_files[:5]) + '...'})")
-                print(
-                    f"- Videos: {num_videos} ({', '.join(video_files) if num_videos < 6 else ', '.join(video_files[:5]) + '...'})")
-                print(
-                    f"- Other Files: {num_other} ({', '.join(other_files) if num_other < 6 else ', '.join(other_files[:5]) + '...'})")
-                print("-" * 50)
-
-                directory_data.append((input_dir, output_dir))
-                conversion_summary.append({
-                    'input': input_dir,
-                    'output': output_dir,
-                    'images': num_images,
-                    'videos': num_videos,
-                    'other': num_other
-                })
-
-        if not directory_data:
-            messagebox.showerror("Error", "No valid directory pairs found")
-            return
-
-        # Fix the total_files calculation to include other files
-        total_files = total_images + total_videos + total_other
-
-        # Print total summary
-        print(f"\nTotal files to convert:")
-        print(f"- Total Images: {total_images}")
-        print(f"- Total Videos: {total_videos}")
-        print(f"- Other Files: {total_other}")
-        print(f"- Grand Total:  {total_files}")
-        print("\n=== End Summary ===\n")
-
-        # Create detailed confirmation message
-        confirm_msg = f"Ready to convert:\n\n"
-        confirm_msg += f"Total Images: {total_images}\n"
-        confirm_msg += f"Total Videos: {total_videos}\n"
-        confirm_msg += f"Other Files: {total_other}\n"
-        confirm_msg += f"Total Files: {total_files}\n\n"
-        confirm_msg += "Start conversion?"
-
-        # Confirm conversion
-        response = messagebox.askyesno("Confirm Conversion", confirm_msg)
-        if not response:
-            print("Conversion cancelled by user")
-            return
-
-        # Disable all buttons during conversion
-        self.convert_button['state'] = 'disabled'
-        self.add_pair_button['state'] = 'disabled'
-        self.remove_pair_button['state'] = 'disabled'
-        for button in self.directory_buttons:
-            button['state'] = 'disabled'
-
-        # Reset and initialize progress bar
-        self.total_progress['value'] = 0
-        self.progress_text['text'] = f"0/{total_files} files"
-
-        print("\nStarting conversion process...")
-
-        def conversion_thread():
-            try:
-                # Process directories concurrently
-                results = self.process_directories(directory_data, total_files)
-
-                # Update GUI with conversion results
-                for pair_results in results:
-                    for status, message in pair_results:
-                        self.status_queue.put(message)
-                        print(message)
-
-                # Clean up output directories
-                print("\nStarting cleanup process...")
-                self.status_queue.put("\nStarting cleanup process...")
-
-                cleanup_all_directories(directory_data)
-
-                # Print completion message
-                print("\nConversion and cleanup completed!")
-                self.status_queue.put("\nConversion and cleanup completed!")
-
-                # Re-enable buttons
-                self.window.after(0, lambda: self.convert_button.configure(state='normal'))
-                self.window.after(0, lambda: self.add_pair_button.configure(state='normal'))
-                self.window.after(0, lambda: self.remove_pair_button.configure(state='normal'))
-                for button in self.directory_buttons:
-                    self.window.after(0, lambda b=button: b.configure(state='normal'))
-                self.window.after(0, lambda: messagebox.showinfo("Complete", "All conversions and cleanup completed!"))
-
-            except Exception as e:
-                error_msg = f"Error during conversion: {str(e)}"
-                self.status_queue.put(error_msg)
-                print(error_msg)
-
-                # Re-enable buttons on error
-                self.window.after(0, lambda: self.convert_button.configure(state='normal'))
-                self.window.after(0, lambda: self.add_pair_button.configure(state='normal'))
-                self.window.after(0, lambda: self.remove_pair_button.configure(state='normal'))
-                for button in self.directory_buttons:
-                    self.window.after(0, lambda b=button: b.configure(state='normal'))
-
-        # Start the conversion thread (fixed indentation)
-        threading.Thread(target=conversion_thread, daemon=True).start()
 
-    def run(self):
-        self.window.mainloop()
+def parse_setting(parser, assignment):
+    """A (key, value) override from a KEY=VALUE argument, the value read as JSON if it is JSON"""
+    key, _, value = assignment.partition('=')
+    if key not in DEFAULT_SETTINGS:
+        parser.error(f"unknown setting: {key}")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main_cli(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert iPhone HEIC photos and MOV videos. "
+                                                 "Without pairs, --watch or --worker the GUI opens.")
+    parser.add_argument('--convert', nargs=2, action='append', metavar=('INPUT_DIR', 'OUTPUT_DIR'),
+                        help="convert without the GUI, writing JSON-lines progress to stdout "
+                             "(can be given more than once)")
+    parser.add_argument('--pairs', action='append', default=[], metavar='FILE',
+                        help="like --convert for every pair in a CSV (input,output rows) or JSON file")
+    parser.add_argument('--mirror', nargs=2, action='append', default=[], metavar=('INPUT_ROOT', 'OUTPUT_ROOT'),
+                        help="like --convert for each subfolder of INPUT_ROOT into the same subfolder "
+                             "of OUTPUT_ROOT")
+    parser.add_argument('--watch', nargs=2, action='append', metavar=('INPUT_DIR', 'OUTPUT_DIR'),
+                        help="run without the GUI, converting files into OUTPUT_DIR as they appear "
+                             "in INPUT_DIR (can be given more than once)")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="override a saved setting for this run, e.g. image_format=jpeg")
+    parser.add_argument('--no-cleanup', action='store_true',
+                        help="keep AAE files and duplicates in the output directories")
+    parser.add_argument('--dry-run', action='store_true', help="only report what cleanup would remove")
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help="with pairs to convert, listen on HOST:PORT and have connected workers "
+                             "convert the files instead of this machine")
+    parser.add_argument('--worker', metavar='HOST:PORT',
+                        help="convert files for the coordinator at HOST:PORT until it is done")
+    parser.add_argument('--stream', action='store_true',
+                        help="with --worker, have files sent over the connection instead of reading "
+                             "the coordinator's paths from a shared filesystem")
+    parser.add_argument('--authkey', default=os.environ.get('MEDIA_CONVERTER_AUTHKEY'),
+                        help="shared secret of the coordinator and its workers "
+                             "(default: $MEDIA_CONVERTER_AUTHKEY)")
+    args = parser.parse_args(argv)
+
+    settings = load_settings()
+    settings.update(parse_setting(parser, assignment) for assignment in args.set)
+
+    pairs = list(args.convert or [])
+    for path in args.pairs:
+        pairs += load_directory_pairs(path)
+    for input_root, output_root in args.mirror:
+        pairs += mirror_directory_pairs(input_root, output_root)
+
+    if (args.coordinator or args.worker) and not args.authkey:
+        parser.error("--coordinator and --worker need --authkey or MEDIA_CONVERTER_AUTHKEY")
+    if args.coordinator and not pairs:
+        parser.error("--coordinator needs pairs to convert")
+
+    if args.worker:
+        import distributed
+        joined = distributed.run_worker(distributed.parse_address(args.worker), args.authkey.encode(),
+                                        args.stream, settings)
+        sys.exit(0 if joined else 1)
+    elif pairs:
+        if args.coordinator:
+            import distributed
+            coordinator = distributed.Coordinator(distributed.parse_address(args.coordinator),
+                                                  args.authkey.encode(), settings)
+            # Keep the coordinator's own messages off the JSON-lines stream too
+            stream = sys.stdout
+            with redirect_stdout(sys.stderr), coordinator:
+                results = convert(pairs, settings, cleanup=not args.no_cleanup, dry_run=args.dry_run,
+                                  stream=stream, executor=coordinator)
+        else:
+            results = convert(pairs, settings, cleanup=not args.no_cleanup, dry_run=args.dry_run)
+        failed = any(status == 'error' for pair_results in results for status, _ in pair_results)
+        sys.exit(1 if failed else 0)
+    elif args.watch:
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            watch_directories(args.watch, settings, stop)
+        except KeyboardInterrupt:
+            pass
+    else:
+        # tkinter is only loaded when the GUI is actually wanted
+        from gui import MediaConverterGUI
+        app = MediaConverterGUI()
+        app.run()
 
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()  # Required for Windows executable
-    app = MediaConverterGUI()
-    app.run()
+    main_cli()